@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import statistics
+import subprocess
+
+
+# Compares the cold start of the geometry-only import of perspectivecorrection with the
+# imports it used to pull in eagerly (numpy plus PIL.Image and PIL.ImageDraw).
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+statements = {
+	"numpy + PIL (previous import)": "import numpy; from PIL import Image, ImageDraw",
+	"perspectivecorrection": "import perspectivecorrection",
+	"perspectivecorrection + find_persp_coeffs_from_lines":
+		"from perspectivecorrection import find_persp_coeffs_from_lines; import sys; assert 'PIL.Image' not in sys.modules",
+}
+
+
+def cold_start(statement, runs):
+	
+	'''
+	
+	Runs statement in fresh interpreters and returns the wall-clock times in milliseconds,
+	with the bare interpreter start-up subtracted.
+	
+	'''
+	
+	def run(code):
+		start = time.perf_counter()
+		subprocess.run([sys.executable, "-c", code], cwd=here, check=True)
+		return 1000 * (time.perf_counter() - start)
+		
+	baseline = statistics.median(run("pass") for _ in range(runs))
+	return [run(statement) - baseline for _ in range(runs)]
+	
+	
+if __name__ == "__main__":
+	
+	runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	
+	for name, statement in statements.items():
+		times = cold_start(statement, runs)
+		print("{:55s} median {:7.1f} ms   min {:7.1f} ms".format(name, statistics.median(times), min(times)))
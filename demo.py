@@ -1,10 +1,18 @@
+import io
 import csv
+import sys
 from perspectivecorrection import *
+from perspectivecache import ResultCache, correct_file
+from PIL import Image
+import numpy as np
 
 sample = []
 path = "./test_images/"
 n = 0
 
+# Pass a directory to cache corrected outputs between runs, e.g. python demo.py ./cache
+cache = ResultCache(sys.argv[1]) if len(sys.argv) > 1 else None
+
 ## We need to handle the case when we don't find a file with the given name
 
 with open(path + "samples.csv") as csvfile:
@@ -26,11 +34,15 @@ for index in range(n):
 	horizontal_lines = lines[:2]
 	vertical_lines = lines[2:]
 	
-	# Run main function on extracted lines
-	coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
-	
-	# Warp original image to correct perspective
-	corrected_image = image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	if cache is None:
+		# Run main function on extracted lines
+		coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
+		
+		# Warp original image to correct perspective
+		corrected_image = image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	else:
+		data, coeffs = correct_file(path + filename, horizontal_lines, vertical_lines, sensor, cache)
+		corrected_image = Image.open(io.BytesIO(data))
 	
 	print("horizontal_lines = " + str(horizontal_lines))
 	print("vertical_lines = " + str(vertical_lines))
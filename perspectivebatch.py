@@ -0,0 +1,256 @@
+import os
+import collections
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from perspectivecorrection import find_persp_coeffs_from_lines
+
+
+# Batch correction across processes without pickling pixels. Workers decode each image
+# themselves (arrays given by the caller are copied once into a shared memory block from a
+# pool), warp it with Image.transform and copy the result into another pooled block, so only
+# paths, descriptors (block name, shape, dtype) and coefficients cross process boundaries.
+
+
+class SharedBuffer (object):
+
+	'''
+
+	An array living in a shared memory block that may be larger than the array itself.
+
+	'''
+
+	def __init__(self, shm, shape, dtype):
+		self.shm = shm
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+
+		# frombuffer keeps an export of the block, so it can't be unmapped under a live view
+		self.array = np.frombuffer(shm.buf, self.dtype, int(np.prod(self.shape))).reshape(self.shape)
+
+
+	@property
+	def descriptor(self):
+		return (self.shm.name, self.shape, self.dtype.str)
+
+
+
+# Blocks of closed pools that were still in use
+_mapped = []
+
+
+
+class BufferPool (object):
+
+	'''
+
+	Reusable pool of shared memory blocks. Block sizes are rounded up to a multiple of
+	granularity so that images of similar size share blocks.
+
+	'''
+
+	def __init__(self, granularity=1 << 20):
+		self.granularity = granularity
+		self.free = []
+		self.blocks = []
+
+
+	def acquire(self, shape, dtype):
+		nbytes = max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1)
+		fits = [shm for shm in self.free if shm.size >= nbytes]
+		if fits:
+			shm = min(fits, key=lambda shm: shm.size)
+			self.free.remove(shm)
+		else:
+			size = -(-nbytes // self.granularity) * self.granularity
+			shm = shared_memory.SharedMemory(create=True, size=size)
+			self.blocks.append(shm)
+		return SharedBuffer(shm, shape, dtype)
+
+
+	def release(self, buffer):
+		buffer.array = None
+		self.free.append(buffer.shm)
+
+
+	def close(self):
+
+		# Blocks that arrays still point into are unlinked but stay mapped until a later close
+		# finds them unused
+		blocks, _mapped[:] = _mapped + self.blocks, []
+		for shm in self.blocks:
+			shm.unlink()
+		for shm in blocks:
+			try:
+				shm.close()
+			except BufferError:
+				_mapped.append(shm)
+		self.blocks, self.free = [], []
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+
+# Blocks already attached by this worker, so each one is only opened once
+_attached = {}
+
+
+def _attach(descriptor):
+	name, shape, dtype = descriptor
+	if name not in _attached:
+		_attached[name] = shared_memory.SharedMemory(name=name)
+	return np.ndarray(shape, np.dtype(dtype), buffer=_attached[name].buf)
+
+
+# Array shapes (after height and width) of the PIL modes the workers render
+_CHANNELS = {"L": (), "RGB": (3,), "RGBA": (4,)}
+
+
+def _mode(array):
+
+	# PIL mode that can wrap array without a copy, or None
+	if array.dtype != np.uint8:
+		return None
+	return {shape: mode for mode, shape in _CHANNELS.items()}.get(array.shape[2:])
+
+
+def _warp_shared(source, output, coeffs):
+
+	# Runs in a worker: decodes a path, or wraps a shared source, warps it with PIL and copies
+	# the result into the shared output
+	from PIL import Image
+
+	out = _attach(output)
+	size = (out.shape[1], out.shape[0])
+	mode = _mode(out)
+	if isinstance(source, str):
+		with Image.open(source) as image:
+			image = image.convert(mode) if image.mode != mode else image
+			corrected = image.transform(size, Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	elif mode is not None:
+		array = _attach(source)
+		image = Image.frombuffer(mode, (array.shape[1], array.shape[0]), array, "raw", mode, 0, 1)
+		corrected = image.transform(size, Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	else:
+		# PIL can't wrap other dtypes or channel counts, the NumPy warp can
+		from perspectivewarp import warp
+		warp(_attach(source), coeffs, size, out=out)
+		return output[0]
+	out[...] = np.asarray(corrected)
+	return output[0]
+
+
+def _describe(item):
+
+	# Returns (name, source, shape, dtype, horizontal_lines, vertical_lines) for a batch item.
+	# Paths are only opened for their header, decoding happens in the workers.
+	name, source, horizontal_lines, vertical_lines = item
+	if isinstance(source, np.ndarray):
+		return name, source, source.shape, source.dtype, horizontal_lines, vertical_lines
+	from PIL import Image
+	with Image.open(source) as image:
+		mode = image.mode if image.mode in _CHANNELS else "RGB"
+		width, height = image.size
+	return name, source, (height, width) + _CHANNELS[mode], np.uint8, horizontal_lines, vertical_lines
+
+
+def run_batch(items, workers=None, depth=None, pool=None):
+
+	'''
+
+	Corrects a batch of images in worker processes, moving pixels through shared memory.
+
+	Input:
+
+		items = iterable of (name, source, horizontal_lines, vertical_lines), where source is a
+			path or an np.array. Arrays of uint8 with 1, 3 or 4 channels are warped with PIL
+			(BICUBIC), others with perspectivewarp.
+		workers = int, number of worker processes.
+		depth = int, number of items in flight at once, which bounds the shared memory in use.
+		pool = BufferPool to take blocks from, a private one is used if not given.
+
+	Output:
+
+		Yields (name, corrected, coeffs) in the order of items. Without a pool, corrected is a
+		copy. With a pool, it is a view of a shared memory block that is recycled once the next
+		result is requested, so copy or save it first.
+
+	'''
+
+	workers = workers or os.cpu_count() or 1
+	depth = depth or 2 * workers
+	own_pool = pool is None
+	pool = pool or BufferPool()
+	pending = collections.deque()
+
+	# Workers must share the parent's resource tracker, otherwise each of them would unlink
+	# the blocks it attached to when it exits
+	resource_tracker.ensure_running()
+
+	try:
+		with multiprocessing.Pool(workers) as processes:
+			items = iter(items)
+			while True:
+
+				# Keep depth items in flight
+				while len(pending) < depth:
+					item = next(items, None)
+					if item is None:
+						break
+					name, source, shape, dtype, horizontal_lines, vertical_lines = _describe(item)
+					height, width = shape[:2]
+					sensor = np.array([[width/2, height/2, 0]])
+					coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
+
+					# Arrays are copied into a block once, files are decoded by the workers
+					shared = None
+					if isinstance(source, np.ndarray):
+						shared = pool.acquire(shape, dtype)
+						shared.array[...] = source
+						source = shared.descriptor
+					output = pool.acquire(shape, dtype)
+					result = processes.apply_async(_warp_shared, (source, output.descriptor, coeffs))
+					pending.append((name, shared, output, coeffs, result))
+
+				if not pending:
+					break
+				name, shared, output, coeffs, result = pending.popleft()
+				result.get()
+				if shared is not None:
+					pool.release(shared)
+				yield name, output.array.copy() if own_pool else output.array, coeffs
+				pool.release(output)
+	finally:
+		if own_pool:
+			pool.close()
+
+
+if __name__ == "__main__":
+
+	import csv
+	import sys
+	import time
+	from PIL import Image
+
+	path = "./test_images/"
+	with open(path + "samples.csv") as csvfile:
+		reader = csv.reader(csvfile)
+		header = next(reader)
+		items = []
+		for row in reader:
+			lines = [[tuple(map(int, row[4*i+1:4*i+3])), tuple(map(int, row[4*i+3:4*i+5]))] for i in range(4)]
+			if os.path.exists(path + row[0]):
+				items.append((row[0], path + row[0], lines[:2], lines[2:]))
+
+	output_dir = sys.argv[1] if len(sys.argv) > 1 else None
+	start = time.perf_counter()
+	for name, corrected, coeffs in run_batch(items * 8):
+		if output_dir:
+			Image.fromarray(corrected).save(os.path.join(output_dir, name))
+	print("{} images in {:.2f} s".format(8 * len(items), time.perf_counter() - start))
@@ -0,0 +1,190 @@
+import io
+import os
+import json
+import hashlib
+import tempfile
+import numpy as np
+from perspectivecorrection import find_persp_coeffs_from_lines, find_output_size
+
+
+class ResultCache (object):
+
+	'''
+
+	Content-addressed on-disk cache for corrected images and their coefficients.
+
+	Entries are keyed by a hash of the source bytes, the lines, the sensor and the output
+	options, so they stay valid however the source file is named or moved. Each entry is a
+	single file written atomically; reading an entry refreshes its modification time, and the
+	least recently used entries are removed once the directory grows past max_bytes.
+
+	Input:
+
+		directory = str, where entries are stored, created if needed.
+		max_bytes = int, size above which the oldest entries are evicted.
+
+	'''
+
+	def __init__(self, directory, max_bytes=2 << 30):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		os.makedirs(directory, exist_ok=True)
+
+		# Index of existing entries, so eviction doesn't have to rescan the directory
+		self.entries = {}
+		for entry in os.scandir(directory):
+			if entry.is_file() and not entry.name.startswith("."):
+				stat = entry.stat()
+				self.entries[entry.name] = (stat.st_mtime, stat.st_size)
+		self.size = sum(size for _, size in self.entries.values())
+
+
+	@staticmethod
+	def key(source, horizontal_lines, vertical_lines, sensor, **options):
+
+		'''
+
+		Returns the cache key for a correction.
+
+		Input:
+
+			source = bytes, the encoded source image.
+			horizontal_lines, vertical_lines, sensor = as in find_persp_coeffs_from_lines.
+			options = output options (format, size, resampling filter, ...).
+
+		'''
+
+		# Normalize coordinates so that e.g. ints and floats or tuples and lists hash the same
+		lines = np.round(np.array([*horizontal_lines, *vertical_lines], dtype=np.float64), 6).tolist()
+		sensor = np.round(np.asarray(sensor, dtype=np.float64).reshape(3), 6).tolist()
+		params = json.dumps([lines, sensor, sorted(options.items())], default=str)
+
+		h = hashlib.sha256(hashlib.sha256(source).digest())
+		h.update(params.encode())
+		return h.hexdigest()
+
+
+	def get(self, key):
+
+		'''
+
+		Returns (data, coeffs) stored under key, or None if there is no such entry.
+
+		'''
+
+		path = os.path.join(self.directory, key)
+		try:
+			with open(path, "rb") as f:
+				meta = json.loads(f.readline())
+				data = f.read()
+		except (OSError, ValueError):
+			return None
+		if len(data) != meta["length"]:
+			return None
+		try:
+			os.utime(path)
+		except OSError:
+			pass
+		if key in self.entries:
+			self.entries[key] = (os.path.getmtime(path), self.entries[key][1])
+		return data, np.array(meta["coeffs"])
+
+
+	def put(self, key, data, coeffs):
+
+		'''
+
+		Stores the encoded output data and its coefficients under key.
+
+		'''
+
+		header = json.dumps({"coeffs": list(map(float, coeffs)), "length": len(data)}).encode() + b"\n"
+
+		# Write to a temporary file in the same directory, then rename it into place
+		fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(header)
+				f.write(data)
+			os.replace(tmp, os.path.join(self.directory, key))
+		except BaseException:
+			os.unlink(tmp)
+			raise
+
+		size = len(header) + len(data)
+		if key in self.entries:
+			self.size -= self.entries[key][1]
+		self.entries[key] = (os.path.getmtime(os.path.join(self.directory, key)), size)
+		self.size += size
+		self.evict()
+
+
+	def evict(self):
+
+		# Remove least recently used entries until the cache fits in max_bytes
+		if self.size <= self.max_bytes:
+			return
+		for key, (_, size) in sorted(self.entries.items(), key=lambda item: item[1][0]):
+			if self.size <= self.max_bytes:
+				break
+			try:
+				os.unlink(os.path.join(self.directory, key))
+			except FileNotFoundError:
+				pass
+			del self.entries[key]
+			self.size -= size
+
+
+
+def correct_file(file, horizontal_lines, vertical_lines, sensor=None, cache=None, format="PNG", size=None):
+
+	'''
+
+	Corrects the image in file and returns it encoded, going through cache if one is given.
+
+	Input:
+
+		file = str, path to the original image.
+		horizontal_lines, vertical_lines = as in find_persp_coeffs_from_lines.
+		sensor = np.array([[x, y, z]]), defaults to the center of the image.
+		cache = ResultCache or None.
+		format = str, output format passed to PIL.
+		size = (width, height) of the output, defaults to the size of the original. "auto"
+			picks the size from the source pixel density, see find_output_size.
+
+	Output:
+
+		(data, coeffs), encoded corrected image and the perspective coefficients.
+
+	'''
+
+	with open(file, "rb") as f:
+		source = f.read()
+
+	image = None
+	if sensor is None:
+		from PIL import Image
+		image = Image.open(io.BytesIO(source))
+		width, height = image.size
+		sensor = np.array([[width/2, height/2, 0]])
+
+	if cache is not None:
+		key = cache.key(source, horizontal_lines, vertical_lines, sensor, format=format, size=size)
+		hit = cache.get(key)
+		if hit is not None:
+			return hit
+
+	from PIL import Image
+	if image is None:
+		image = Image.open(io.BytesIO(source))
+	coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
+	if size == "auto":
+		size, coeffs = find_output_size(coeffs, image.size)
+	corrected_image = image.transform(size or image.size, Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	with io.BytesIO() as bIO:
+		corrected_image.save(bIO, format)
+		data = bIO.getvalue()
+
+	if cache is not None:
+		cache.put(key, data, coeffs)
+	return data, coeffs
@@ -1,6 +1,25 @@
-from PIL import Image, ImageDraw
 import numpy as np
 
+# PIL is only imported by the functions that touch pixels, so the geometry can be used
+# without paying for it at import time.
+
+__all__ = [
+	"intersect",
+	"get_focal_distance",
+	"project_to_plane",
+	"find_perspective_coeffs",
+	"find_perspective_coeffs_batch",
+	"find_persp_coeffs_from_lines",
+	"find_persp_coeffs_from_planes",
+	"score_lines",
+	"score_lines_batch",
+	"map_to_original",
+	"map_to_corrected",
+	"find_output_size",
+	"draw_lines",
+	"correct_planes",
+]
+
 
 # User identifies a pair of horizontal line segments and a pair of vertical line segments.
 
@@ -113,7 +132,7 @@ def find_perspective_coeffs(pa, pb):
 		matrix.append([p1[0], p1[1], 1, 0, 0, 0, -p2[0]*p1[0], -p2[0]*p1[1]])
 		matrix.append([0, 0, 0, p1[0], p1[1], 1, -p2[1]*p1[0], -p2[1]*p1[1]])
 
-	A = np.matrix(matrix, dtype=np.float)
+	A = np.matrix(matrix, dtype=np.float64)
 	B = np.array(pb).reshape(8)
 
 	res = np.dot(np.linalg.inv(A.T * A) * A.T, B)
@@ -121,6 +140,7 @@ def find_perspective_coeffs(pa, pb):
 	
 	
 def draw_lines(image, lines, r):
+	from PIL import ImageDraw
 	draw = ImageDraw.Draw(image)
 	for p, q in lines:
 		draw.ellipse((p[0]-r, p[1]-r, p[0]+r, p[1]+r), fill = "#007fff")
@@ -128,7 +148,7 @@ def draw_lines(image, lines, r):
 		draw.line((*p, *q), fill = "#007fff", width = r)
 	
 	
-def find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor):
+def find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor, camera=None):
 	
 	'''
 	
@@ -144,6 +164,9 @@ def find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor):
 		vertical_lines = [[(xv11, yv11), (xv12, yv12)], [(xv21, yv21), (xv22, yv22)]],
 			a pair of user-identified vertical lines, each given by a list of two points.
 		sensor = np.array([[x, y, z]]), the location of the sensor.
+		camera = perspectivelens.Camera, lens distortion of the image. The lines are
+			undistorted first, and the coefficients then map to undistorted source coordinates,
+			so the warp has to apply the same camera (see perspectivewarp.warp).
 		
 	Output:
 		
@@ -151,6 +174,10 @@ def find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor):
 		
 	'''
 	
+	if camera is not None:
+		horizontal_lines = camera.undistort_lines(horizontal_lines)
+		vertical_lines = camera.undistort_lines(vertical_lines)
+	
 	# Get quadrilateral vertices by intersecting horizontal lines with vertical lines
 	quad = [intersect(hl, vl) for hl in horizontal_lines for vl in vertical_lines]
 	
@@ -195,8 +222,454 @@ def find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor):
 	return coeffs
 
 
+def _to_matrix(coeffs):
+	
+	'''
+	
+	Expands perspective coefficients c0, ..., c7 (or a stack of them) into 3x3 matrices.
+	
+	'''
+	
+	coeffs = np.asarray(coeffs, dtype=np.float64)
+	ones = np.ones(coeffs.shape[:-1] + (1,))
+	return np.concatenate((coeffs, ones), axis=-1).reshape(coeffs.shape[:-1] + (3, 3))
+	
+	
+def _to_coeffs(H):
+	
+	'''
+	
+	Normalizes 3x3 matrices (or a stack of them) back into perspective coefficients c0, ..., c7.
+	
+	'''
+	
+	H = np.asarray(H, dtype=np.float64)
+	H = H / H[..., 2:, 2:]
+	return H.reshape(H.shape[:-2] + (9,))[..., :8]
+	
+	
+def _apply_matrix(points, H, dtype):
+	
+	'''
+	
+	Applies the 3x3 matrix H to an (N, 2) array of points without forming homogeneous copies.
+	
+	'''
+	
+	points = np.asarray(points, dtype=dtype)
+	H = H.astype(dtype)
+	x, y = points[..., 0], points[..., 1]
+	w = H[2, 0] * x + H[2, 1] * y + H[2, 2]
+	out = np.empty(points.shape, dtype=dtype)
+	out[..., 0] = (H[0, 0] * x + H[0, 1] * y + H[0, 2]) / w
+	out[..., 1] = (H[1, 0] * x + H[1, 1] * y + H[1, 2]) / w
+	return out
+	
+	
+def map_to_original(points, coeffs, dtype=np.float64):
+	
+	'''
+	
+	Maps points in the corrected image back to the original image, using the same
+	coefficients that are passed to Image.transform.
+	
+	Input:
+		
+		points = np.array of shape (N, 2), points in the corrected image.
+		coeffs = np.array([c0, ..., c7]), coefficients from find_persp_coeffs_from_lines.
+		dtype = np.float64 or np.float32, precision of the computation and of the output.
+		
+	Output:
+		
+		np.array of shape (N, 2), corresponding points in the original image.
+		
+	'''
+	
+	return _apply_matrix(points, _to_matrix(coeffs), dtype)
+	
+	
+def map_to_corrected(points, coeffs, dtype=np.float64):
+	
+	'''
+	
+	Maps points in the original image (annotations, boxes, keypoints) to the corrected image.
+	This is the inverse of map_to_original.
+	
+	Input:
+		
+		points = np.array of shape (N, 2), points in the original image.
+		coeffs = np.array([c0, ..., c7]), coefficients from find_persp_coeffs_from_lines.
+		dtype = np.float64 or np.float32, precision of the computation and of the output.
+		
+	Output:
+		
+		np.array of shape (N, 2), corresponding points in the corrected image.
+		
+	'''
+	
+	return _apply_matrix(points, np.linalg.inv(_to_matrix(coeffs)), dtype)
+	
+	
+def find_output_size(coeffs, source_size, box=None, density="median", max_pixels=None, samples=32):
+	
+	'''
+	
+	Chooses the output size from the source pixel density instead of reusing the size of the
+	original. The Jacobian of the homography tells how many source pixels each output pixel
+	covers; the output is scaled uniformly, so the aspect ratio of the corrected rectangle is
+	kept, until that density matches the source.
+	
+	Input:
+		
+		coeffs = np.array([c0, ..., c7]), coefficients from find_persp_coeffs_from_lines.
+		source_size = (width, height) of the original image.
+		box = (left, top, right, bottom), region of the corrected image to keep. Defaults to the
+			(width, height) frame that Image.transform would render, cropped to the part of it
+			covered by the original image.
+		density = "median" to match the typical source density over the box, or "max" to keep
+			the densest part of the source (the largest output).
+		max_pixels = int, optional budget for width * height of the output.
+		samples = int, number of points sampled along each side of the box.
+		
+	Output:
+		
+		(size, coeffs), the (width, height) of the output and the coefficients to render the
+		box at that size.
+		
+	'''
+	
+	H = _to_matrix(coeffs)
+	width, height = source_size
+	if box is None:
+		box = np.array([0, 0, width, height], dtype=np.float64)
+		
+		# Crop to the footprint of the original, unless it reaches past the horizon
+		corners = np.array([[0, 0], [width, 0], [0, height], [width, height]], dtype=np.float64)
+		with np.errstate(divide="ignore", invalid="ignore"):
+			footprint = _apply_matrix(corners, np.linalg.inv(H), np.float64)
+		w = np.linalg.inv(H)[2] @ np.array([[0, width, 0, width], [0, 0, height, height], [1, 1, 1, 1]])
+		if np.all(w > 0):
+			box = np.concatenate((np.maximum(box[:2], footprint.min(axis=0)), np.minimum(box[2:], footprint.max(axis=0))))
+	left, top, right, bottom = box
+	
+	# For a homography, |det J| = |det H| / w^3 with w the homogeneous coordinate
+	u = np.linspace(left, right, samples)
+	v = np.linspace(top, bottom, samples)[:, None]
+	w = H[2, 0] * u + H[2, 1] * v + H[2, 2]
+	x = (H[0, 0] * u + H[0, 1] * v + H[0, 2]) / w
+	y = (H[1, 0] * u + H[1, 1] * v + H[1, 2]) / w
+	inside = (w > 0) & (x >= 0) & (x <= width) & (y >= 0) & (y <= height)
+	if not np.any(inside):
+		inside = w > 0
+	scale = np.sqrt(np.abs(np.linalg.det(H) / w[inside] ** 3))
+	scale = np.max(scale) if density == "max" else np.median(scale)
+	
+	# Round down when the budget applies so that it is never exceeded
+	fit = np.round
+	if max_pixels is not None and scale ** 2 * (right - left) * (bottom - top) > max_pixels:
+		scale = np.sqrt(max_pixels / ((right - left) * (bottom - top)))
+		fit = np.floor
+	size = (max(int(fit((right - left) * scale)), 1), max(int(fit((bottom - top) * scale)), 1))
+	
+	# Output pixel (u, v) of the new image is at ((u / sx) + left, (v / sy) + top) in the box
+	sx, sy = size[0] / (right - left), size[1] / (bottom - top)
+	S = np.array([[1 / sx, 0, left], [0, 1 / sy, top], [0, 0, 1]])
+	return size, _to_coeffs(H @ S)
+	
+	
+def _intersect_batch(p1, q1, p2, q2):
+	
+	'''
+	
+	Vectorized version of intersect for stacks of lines, each point given as an array of shape (..., 2).
+	
+	'''
+	
+	ones = np.ones(np.shape(p1)[:-1] + (1,))
+	n1 = np.cross(np.concatenate((p1, ones), axis=-1), np.concatenate((q1, ones), axis=-1))
+	n2 = np.cross(np.concatenate((p2, ones), axis=-1), np.concatenate((q2, ones), axis=-1))
+	x = np.cross(n1, n2)
+	return x[..., :2] / x[..., 2:]
+	
+	
+def _rectify_planes(lines, sensor):
+	
+	'''
+	
+	Vectorized version of the geometry in find_persp_coeffs_from_lines, run for many planes at once.
+	
+	Input:
+		
+		lines = np.array of shape (N, 4, 2, 2), the two horizontal lines followed by the two
+			vertical lines of each plane, each line given by two points.
+		sensor = np.array of shape (N, 3) or (1, 3), the location of the sensor for each plane.
+		
+	Output:
+		
+		rect = np.array of shape (N, 4, 2), corrected vertices in the focal plane.
+		quad = np.array of shape (N, 4, 2), original vertices in the focal plane.
+		focal_distance = np.array of shape (N,), nan where the focal distance is imaginary.
+		
+	'''
+	
+	lines = np.asarray(lines, dtype=np.float64)
+	sensor = np.broadcast_to(np.asarray(sensor, dtype=np.float64).reshape(-1, 3), (len(lines), 3))
+	h, v = lines[:, :2], lines[:, 2:]
+	
+	# Quad vertices in the same order as find_persp_coeffs_from_lines: h0v0, h0v1, h1v0, h1v1
+	quad = _intersect_batch(h[:, [0, 0, 1, 1], 0], h[:, [0, 0, 1, 1], 1], v[:, [0, 1, 0, 1], 0], v[:, [0, 1, 0, 1], 1])
+	h_int = _intersect_batch(quad[:, 0], quad[:, 1], quad[:, 2], quad[:, 3])
+	v_int = _intersect_batch(quad[:, 0], quad[:, 2], quad[:, 1], quad[:, 3])
+	
+	# Focal distance, left as nan when the vanishing points give an imaginary one
+	s = sensor[:, :2]
+	f2 = - np.sum((h_int - s) * (v_int - s), axis=-1)
+	focal_distance = np.sqrt(np.where(f2 >= 0, f2, np.nan))
+	f = focal_distance[:, None]
+	
+	# Vector normal to target plane, pointing towards positive z
+	normal = np.cross(np.concatenate((h_int, f), axis=-1) - sensor, np.concatenate((v_int, f), axis=-1) - sensor)
+	normal /= np.linalg.norm(normal, axis=-1, keepdims=True) * np.sign(normal[:, 2:])
+	
+	# Project quad onto target plane
+	shift = np.concatenate((np.zeros((len(lines), 2)), f), axis=-1)
+	quad3 = np.concatenate((quad, np.broadcast_to(f[:, None], quad.shape[:2] + (1,))), axis=-1)
+	p = quad3 - sensor[:, None]
+	c = np.sum(normal * shift, axis=-1)[:, None] / np.einsum("nk,nik->ni", normal, p)
+	target_rect = c[..., None] * p + sensor[:, None]
+	
+	# Rotate target plane so normal points forward and rectangle aligns with axes
+	h_axis = target_rect[:, 1] - target_rect[:, 0]
+	h_axis /= np.linalg.norm(h_axis, axis=-1, keepdims=True) * np.sign(h_axis[:, :1])
+	R = np.stack((h_axis, np.cross(normal, h_axis), normal), axis=-1)
+	offset = (sensor + shift)[:, None]
+	rotate_rect = np.einsum("nik,nkj->nij", target_rect - offset, R) + offset
+	rect_center = 0.5 * (rotate_rect[:, 0] + rotate_rect[:, 3])
+	centered_rect = rotate_rect - rect_center[:, None] + (sensor + 2*shift)[:, None]
+	
+	# Project centered_rect back to focal plane
+	p = centered_rect - sensor[:, None]
+	rect = f[..., None] / p[..., 2:] * p + sensor[:, None]
+	
+	return rect[..., :2], quad, focal_distance
+	
+	
+def find_perspective_coeffs_batch(pa, pb):
+	
+	'''
+	
+	Solves find_perspective_coeffs for a stack of point correspondences in a single call.
+	
+	Input:
+		
+		pa = np.array of shape (N, 4, 2), points in the corrected image.
+		pb = np.array of shape (N, 4, 2), corresponding points in the original image.
+		
+	Output:
+		
+		coeffs = np.array of shape (N, 8), perspective coefficients for each correspondence.
+		
+	'''
+	
+	pa, pb = np.asarray(pa, dtype=np.float64), np.asarray(pb, dtype=np.float64)
+	x, y = pa[..., 0], pa[..., 1]
+	u, v = pb[..., 0], pb[..., 1]
+	
+	A = np.zeros(pa.shape[:-2] + (8, 8))
+	A[..., 0::2, 0], A[..., 0::2, 1], A[..., 0::2, 2] = x, y, 1
+	A[..., 1::2, 3], A[..., 1::2, 4], A[..., 1::2, 5] = x, y, 1
+	A[..., 0::2, 6], A[..., 0::2, 7] = -u*x, -u*y
+	A[..., 1::2, 6], A[..., 1::2, 7] = -v*x, -v*y
+	B = pb.reshape(pb.shape[:-2] + (8, 1))
+	
+	return np.linalg.solve(A, B)[..., 0]
+	
+	
+def find_persp_coeffs_from_planes(planes, sensor):
+	
+	'''
+	
+	Batched version of find_persp_coeffs_from_lines for several planes in the same image.
+	
+	Input:
+		
+		planes = [(horizontal_lines, vertical_lines), ...], line pairs for each plane,
+			given as in find_persp_coeffs_from_lines.
+		sensor = np.array([[x, y, z]]), the location of the sensor.
+		
+	Output:
+		
+		coeffs = np.array of shape (N, 8), the perspective coefficients for each plane.
+		
+	'''
+	
+	lines = np.array([[*hl, *vl] for hl, vl in planes], dtype=np.float64)
+	rect, quad, _ = _rectify_planes(lines, sensor)
+	return find_perspective_coeffs_batch(rect, quad)
+	
+	
+def score_lines_batch(lines, sensor, noise=1.0, samples=32, seed=0):
+	
+	'''
+	
+	Estimates how sensitive the correction of each item is to noise in the line endpoints,
+	without warping anything. Each item is re-solved for a batch of randomly perturbed copies
+	of its endpoints and the spread of the resulting rectangles is measured.
+	
+	Input:
+		
+		lines = np.array of shape (N, 4, 2, 2), the two horizontal lines followed by the two
+			vertical lines of each item.
+		sensor = np.array of shape (N, 3) or (1, 3), the location of the sensor.
+		noise = float, standard deviation of the endpoint noise in pixels.
+		samples = int, number of perturbed copies of each item.
+		seed = int, seed of the random perturbations.
+		
+	Output:
+		
+		dict of np.arrays of shape (N,):
+			"sensitivity", RMS over the perturbed copies of the largest displacement of a
+				corrected corner, relative to the diagonal of the corrected rectangle (inf when
+				the focal distance is imaginary),
+			"aspect", aspect ratio (width / height) of the corrected rectangle,
+			"aspect_spread", relative standard deviation of the aspect ratio under noise,
+			"imaginary_focal", whether get_focal_distance is imaginary for the given lines,
+			"imaginary_fraction", fraction of perturbed copies with an imaginary focal distance.
+		
+	'''
+	
+	lines = np.asarray(lines, dtype=np.float64)
+	sensor = np.broadcast_to(np.asarray(sensor, dtype=np.float64).reshape(-1, 3), (len(lines), 3))
+	n = len(lines)
+	
+	rng = np.random.default_rng(seed)
+	perturbed = lines[:, None] + rng.normal(0, noise, (n, samples, 4, 2, 2))
+	
+	# Corners are ordered h0v0, h0v1, h1v0, h1v1, so rect[1] - rect[0] spans the width
+	aspect = lambda r: np.linalg.norm(r[..., 1, :] - r[..., 0, :], axis=-1) / np.linalg.norm(r[..., 2, :] - r[..., 0, :], axis=-1)
+	
+	# Imaginary focal distances propagate as nan and are only counted, not warned about
+	with np.errstate(invalid="ignore", divide="ignore"):
+		rect0, _, f0 = _rectify_planes(lines, sensor)
+		rect, _, f = _rectify_planes(perturbed.reshape(-1, 4, 2, 2), np.repeat(sensor, samples, axis=0))
+		rect = rect.reshape(n, samples, 4, 2)
+		f = f.reshape(n, samples)
+		
+		diagonal = np.linalg.norm(rect0[:, 3] - rect0[:, 0], axis=-1)
+		displacement = np.max(np.linalg.norm(rect - rect0[:, None], axis=-1), axis=-1) / diagonal[:, None]
+		aspect0, aspects = aspect(rect0), aspect(rect)
+		
+		valid = np.isfinite(displacement)
+		count = valid.sum(axis=1)
+		sensitivity = np.sqrt(np.where(valid, displacement ** 2, 0).sum(axis=1) / count)
+		mean_aspect = np.where(valid, aspects, 0).sum(axis=1) / count
+		aspect_spread = np.sqrt(np.where(valid, (aspects - mean_aspect[:, None]) ** 2, 0).sum(axis=1) / count) / aspect0
+		
+	imaginary = np.isnan(f0)
+	imaginary_fraction = np.mean(np.isnan(f), axis=1)
+	sensitivity[imaginary | ~np.isfinite(sensitivity)] = np.inf
+	
+	return {
+		"sensitivity": sensitivity,
+		"aspect": aspect0,
+		"aspect_spread": aspect_spread,
+		"imaginary_focal": imaginary,
+		"imaginary_fraction": imaginary_fraction,
+	}
+	
+	
+def score_lines(horizontal_lines, vertical_lines, sensor, noise=1.0, samples=32, seed=0):
+	
+	'''
+	
+	Quality score for a single set of lines, see score_lines_batch. Lower sensitivity is better;
+	items with an imaginary focal distance or a large sensitivity should be rejected or reviewed
+	before paying for the warp.
+	
+	Input:
+		
+		horizontal_lines, vertical_lines, sensor = as in find_persp_coeffs_from_lines.
+		
+	Output:
+		
+		dict of floats with the same keys as score_lines_batch.
+		
+	'''
+	
+	lines = np.array([[*horizontal_lines, *vertical_lines]], dtype=np.float64)
+	scores = score_lines_batch(lines, sensor, noise, samples, seed)
+	return {key: value[0].item() for key, value in scores.items()}
+	
+	
+def correct_planes(image, planes, sensor=None, resample=None, atlas=False):
+	
+	'''
+	
+	Renders the rectified patch of each plane in one pass over a single decoded image.
+	Each patch only reads the part of the image covered by its quadrilateral.
+	
+	Input:
+		
+		image = PIL.Image, the original image.
+		planes = [(horizontal_lines, vertical_lines), ...], line pairs for each plane.
+		sensor = np.array([[x, y, z]]), the location of the sensor, defaults to the image center.
+		resample = PIL resampling filter used for the warp, defaults to Image.BICUBIC.
+		atlas = bool, whether to paste the patches side by side into a single image.
+		
+	Output:
+		
+		patches = [patch1, patch2, ...], list of rectified PIL images, or
+		(atlas, boxes) if atlas is True, where boxes[i] = (left, top, right, bottom) of patch i.
+		
+	'''
+	
+	from PIL import Image
+	
+	width, height = image.size
+	if sensor is None:
+		sensor = np.array([[width/2, height/2, 0]])
+	if resample is None:
+		resample = Image.BICUBIC
+	lines = np.array([[*hl, *vl] for hl, vl in planes], dtype=np.float64)
+	rect, quad, _ = _rectify_planes(lines, sensor)
+	H = _to_matrix(find_perspective_coeffs_batch(rect, quad))
+	
+	# Leave a small margin around the source footprint for the resampling filter
+	pad = 3
+	image.load()
+	patches = []
+	for i in range(len(lines)):
+		ox, oy = np.floor(rect[i].min(axis=0))
+		ex, ey = np.ceil(rect[i].max(axis=0))
+		left, top = np.maximum(np.floor(quad[i].min(axis=0)) - pad, 0)
+		right, bottom = np.minimum(np.ceil(quad[i].max(axis=0)) + pad, (width, height))
+		
+		# Shift output coordinates to the patch and source coordinates to the crop
+		shift_out = np.array([[1, 0, ox], [0, 1, oy], [0, 0, 1]])
+		shift_in = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]])
+		coeffs = _to_coeffs(shift_in @ H[i] @ shift_out)
+		
+		source = image.crop((int(left), int(top), int(right), int(bottom)))
+		patches.append(source.transform((int(ex - ox), int(ey - oy)), Image.PERSPECTIVE, coeffs, resample))
+		
+	if not atlas:
+		return patches
+		
+	boxes, x = [], 0
+	for patch in patches:
+		boxes.append((x, 0, x + patch.width, patch.height))
+		x += patch.width
+	sheet = Image.new(image.mode, (x, max(patch.height for patch in patches)))
+	for patch, box in zip(patches, boxes):
+		sheet.paste(patch, box[:2])
+		
+	return sheet, boxes
+	
+	
 if __name__ == "__main__":
 	
+	from PIL import Image
+	
 	file = "./test_images/test_3.png"
 	image = Image.open(file)
 	width, height = image.size
@@ -0,0 +1,290 @@
+import os
+import sys
+import json
+import time
+import shutil
+import numpy as np
+from perspectivecorrection import find_persp_coeffs_from_lines
+
+
+# Hot folder ingestion. Images are picked up once an annotation sidecar with the same stem
+# exists next to them, e.g. scan_0042.png and scan_0042.json containing
+#
+#   {"horizontal_lines": [[[x, y], [x, y]], [[x, y], [x, y]]], "vertical_lines": [...]}
+#
+# or {"lines": [h1, h2, v1, v2]} in the order used by samples.csv. Progress is recorded in an
+# append-only manifest (one JSON record per line), so that after a crash or restart completed
+# work is skipped and items that were in flight or failed are retried. An item is identified
+# by the size and modification time of its image and sidecar, so files rewritten in place are
+# picked up again. Once corrected, the image and sidecar are moved out of the watched tree
+# into output_dir/processed, so a poll only lists what is still pending instead of every file
+# ever dropped.
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+
+class HotFolder (object):
+
+	'''
+
+	Watches a directory tree for annotated images and corrects them.
+
+	Input:
+
+		watch_dir = str, directory the scanners drop images and sidecars into.
+		output_dir = str, where corrected images and the manifest are written.
+		format = str, format of the corrected images.
+		max_attempts = int, number of times a failing item is tried before it is left alone.
+		settle = float, seconds a file must be left untouched before it is picked up.
+		archive = bool, move the inputs of completed items to output_dir/processed. Without
+			it, every poll lists and checks every input ever dropped.
+
+	'''
+
+	def __init__(self, watch_dir, output_dir, format="PNG", max_attempts=3, settle=2.0, archive=True):
+		self.watch_dir = watch_dir
+		self.output_dir = output_dir
+		self.format = format
+		self.max_attempts = max_attempts
+		self.settle = settle
+		self.archive_dir = os.path.join(output_dir, "processed") if archive else None
+		os.makedirs(output_dir, exist_ok=True)
+
+		self.items = {}
+		self.manifest_path = os.path.join(output_dir, "manifest.jsonl")
+		self.replay()
+		self.manifest = open(self.manifest_path, "a")
+
+
+	def replay(self):
+
+		'''
+
+		Rebuilds the state of every item from the manifest.
+
+		'''
+
+		if not os.path.exists(self.manifest_path):
+			return
+		with open(self.manifest_path) as manifest:
+			for line in manifest:
+				try:
+					record = json.loads(line)
+				except ValueError:
+					# A torn last line from a crash mid-write
+					continue
+				if "name" not in record:
+					continue
+				item = self.items.setdefault(record["name"], {"attempts": 0})
+				if item.get("version") != record["version"]:
+					item["attempts"] = 0
+				item["version"] = record["version"]
+				item["status"] = record["status"]
+				if record["status"] == "started":
+					item["attempts"] += 1
+
+
+	def record(self, **record):
+		record["time"] = time.time()
+		self.manifest.write(json.dumps(record) + "\n")
+		self.manifest.flush()
+		os.fsync(self.manifest.fileno())
+
+
+	def pending(self, name, version):
+		item = self.items.get(name)
+		if item is None or item["version"] != version:
+			return True
+		if item["status"] == "done":
+			return False
+		return item["attempts"] < self.max_attempts
+
+
+	def scan(self):
+
+		'''
+
+		Yields the entries of every directory under the watched one.
+
+		'''
+
+		stack = [self.watch_dir]
+		while stack:
+			directory = stack.pop()
+			try:
+				entries = list(os.scandir(directory))
+			except FileNotFoundError:
+				continue
+			stack.extend(e.path for e in entries if e.is_dir() and os.path.abspath(e.path) != os.path.abspath(self.output_dir))
+			yield entries
+
+
+	def run_once(self):
+
+		'''
+
+		Processes every new or retryable item once. Returns the number of items processed.
+
+		'''
+
+		processed = 0
+		now = time.time()
+		for entries in self.scan():
+			files = {e.name: e for e in entries if e.is_file()}
+			for name, entry in files.items():
+				stem, ext = os.path.splitext(name)
+				if ext.lower() not in IMAGE_EXTENSIONS:
+					continue
+				sidecar = files.get(stem + ".json")
+				if sidecar is None:
+					continue
+				stats = [entry.stat(), sidecar.stat()]
+				if now - max(s.st_mtime for s in stats) < self.settle:
+					continue
+
+				# Size and mtime of both files identify the version of an item
+				key = os.path.relpath(entry.path, self.watch_dir)
+				version = "{}-{}-{}-{}".format(stats[0].st_size, stats[0].st_mtime_ns, stats[1].st_size, stats[1].st_mtime_ns)
+				if self.pending(key, version):
+					self.process(key, version, entry.path, sidecar.path)
+					processed += 1
+
+				# Also archives items completed before a crash that came ahead of their move
+				if self.archive_dir and self.items[key]["status"] == "done" and self.items[key]["version"] == version:
+					self.archive(key, entry.path, sidecar.path, [files[n].path for n in files if n != name and os.path.splitext(n)[0] == stem])
+		return processed
+
+
+	def archive(self, key, image_path, sidecar_path, siblings):
+
+		'''
+
+		Moves the image of a completed item to the archive, keeping its path relative to the
+		watched directory. The sidecar follows once no other image in siblings still needs it.
+
+		'''
+
+		target = os.path.join(self.archive_dir, key)
+		os.makedirs(os.path.dirname(target), exist_ok=True)
+		shutil.move(image_path, target)
+		if not any(os.path.exists(path) for path in siblings if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS):
+			shutil.move(sidecar_path, os.path.join(os.path.dirname(target), os.path.basename(sidecar_path)))
+
+
+	def process(self, key, version, image_path, sidecar_path):
+		item = self.items.setdefault(key, {"attempts": 0})
+		if item.get("version") != version:
+			item["attempts"] = 0
+		item.update(version=version, status="started")
+		item["attempts"] += 1
+		self.record(name=key, version=version, status="started")
+		try:
+			coeffs = correct(image_path, sidecar_path, self.output_path(key), self.format)
+		except Exception as error:
+			item["status"] = "failed"
+			self.record(name=key, version=version, status="failed", error=repr(error))
+		else:
+			item["status"] = "done"
+			self.record(name=key, version=version, status="done", coeffs=list(map(float, coeffs)))
+
+
+	def output_path(self, key):
+
+		# The source extension is kept, so scan.png and scan.jpg don't write the same output
+		return os.path.join(self.output_dir, key + "." + self.format.lower())
+
+
+	def watch(self, poll=2.0):
+		while True:
+			if not self.run_once():
+				time.sleep(poll)
+
+
+	def close(self):
+		self.manifest.close()
+
+
+
+def read_sidecar(path):
+
+	'''
+
+	Reads the horizontal and vertical lines from an annotation sidecar.
+
+	'''
+
+	with open(path) as f:
+		annotation = json.load(f)
+	if "lines" in annotation:
+		lines = annotation["lines"]
+		horizontal_lines, vertical_lines = lines[:2], lines[2:]
+	else:
+		horizontal_lines, vertical_lines = annotation["horizontal_lines"], annotation["vertical_lines"]
+	to_lines = lambda lines: [[tuple(p) for p in line] for line in lines]
+	return to_lines(horizontal_lines), to_lines(vertical_lines)
+
+
+def correct(image_path, sidecar_path, output_path, format="PNG"):
+
+	'''
+
+	Corrects a single image and writes it atomically to output_path. The file and its directory
+	are synced before the item can be recorded as done. Returns the coefficients.
+
+	'''
+
+	from PIL import Image
+
+	horizontal_lines, vertical_lines = read_sidecar(sidecar_path)
+	image = Image.open(image_path)
+	width, height = image.size
+	sensor = np.array([[width/2, height/2, 0]])
+	coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
+	corrected_image = image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+
+	directory = os.path.dirname(output_path)
+	os.makedirs(directory, exist_ok=True)
+	tmp = output_path + ".tmp"
+	try:
+		with open(tmp, "wb") as f:
+			corrected_image.save(f, format)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp, output_path)
+	except BaseException:
+		if os.path.exists(tmp):
+			os.remove(tmp)
+		raise
+	_sync_directory(directory)
+	return coeffs
+
+
+def _sync_directory(directory):
+
+	# Makes a rename in directory durable, where directories can be opened
+	try:
+		fd = os.open(directory, os.O_RDONLY)
+	except OSError:
+		return
+	try:
+		os.fsync(fd)
+	except OSError:
+		pass
+	finally:
+		os.close(fd)
+
+
+if __name__ == "__main__":
+
+	if len(sys.argv) < 3:
+		print("usage: python perspectivefolder.py WATCH_DIR OUTPUT_DIR [--once]")
+		sys.exit(1)
+
+	folder = HotFolder(sys.argv[1], sys.argv[2])
+	try:
+		if "--once" in sys.argv:
+			print("{} items processed".format(folder.run_once()))
+		else:
+			folder.watch()
+	finally:
+		folder.close()
@@ -0,0 +1,383 @@
+import os
+import zlib
+import struct
+import numpy as np
+
+
+# Memory-mapped input and output for uncompressed TIFF and raw files. Pixels are accessed
+# through the page cache as NumPy views instead of being decoded into a private copy, and
+# perspectivewarp can read from and write into them directly. The PNG and TIFF writers
+# encode an image band by band as it is rendered.
+
+_TYPES = {1: "B", 2: "s", 3: "H", 4: "I", 16: "Q"}
+_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 16: 8}
+_SAMPLE_FORMATS = {1: "u", 2: "i", 3: "f"}
+
+
+def open_raw(path, shape, dtype=np.uint8, offset=0):
+
+	'''
+
+	Memory-maps a raw dump of pixels as a read-only array.
+
+	Input:
+
+		path = str, raw file.
+		shape = (height, width) or (height, width, channels).
+		dtype = pixel type.
+		offset = int, number of header bytes before the pixels.
+
+	'''
+
+	return np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=tuple(shape))
+
+
+def read_tiff_tags(path):
+
+	'''
+
+	Reads the tags of the first image of a classic TIFF file. Returns (byte order, tags).
+
+	'''
+
+	with open(path, "rb") as f:
+		header = f.read(8)
+		order = {b"II": "<", b"MM": ">"}.get(header[:2])
+		if order is None or struct.unpack(order + "H", header[2:4])[0] != 42:
+			raise ValueError("{} is not a classic TIFF file".format(path))
+		f.seek(struct.unpack(order + "I", header[4:8])[0])
+		count, = struct.unpack(order + "H", f.read(2))
+		entries = f.read(12 * count)
+
+		tags = {}
+		for i in range(count):
+			tag, kind, n, value = struct.unpack(order + "HHI4s", entries[12*i:12*i + 12])
+			if kind not in _TYPES:
+				continue
+			size = _SIZES[kind] * n
+			if size > 4:
+				f.seek(struct.unpack(order + "I", value)[0])
+				value = f.read(size)
+			values = struct.unpack(order + _TYPES[kind] * n if kind != 2 else "{}s".format(n), value[:size])
+			tags[tag] = values
+	return order, tags
+
+
+
+class TiledArray (object):
+
+	'''
+
+	Read-only array view of a TIFF whose pixels are split into tiles or strips that are not
+	contiguous in the file. It supports the take_flat gather used by perspectivewarp, so the
+	warp reads only the pixels it samples, straight from the memory-mapped file.
+
+	'''
+
+	def __init__(self, path, shape, dtype, offsets, tile_width, tile_height):
+		self.raw = np.memmap(path, dtype=np.uint8, mode="r")
+		self.shape = tuple(shape)
+		self.dtype = np.dtype(dtype)
+		self.offsets = np.asarray(offsets, dtype=np.int64)
+		self.tile_width = tile_width
+		self.tile_height = tile_height
+		self.tiles_across = -(-shape[1] // tile_width)
+		self.pixel_bytes = self.dtype.itemsize * (shape[2] if len(shape) > 2 else 1)
+
+
+	def take_flat(self, index):
+		width = self.shape[1]
+		y, x = np.divmod(index, width)
+		tile = (y // self.tile_height) * self.tiles_across + x // self.tile_width
+		pos = self.offsets[tile] + ((y % self.tile_height) * self.tile_width + x % self.tile_width) * self.pixel_bytes
+		data = self.raw[pos[:, None] + np.arange(self.pixel_bytes)]
+		return data.view(self.dtype).reshape((len(index),) + self.shape[2:])
+
+
+	def __array__(self, dtype=None, copy=None):
+		flat = self.take_flat(np.arange(self.shape[0] * self.shape[1]))
+		return flat.reshape(self.shape).astype(dtype or self.dtype, copy=False)
+
+
+
+def open_tiff(path):
+
+	'''
+
+	Memory-maps an uncompressed, chunky (interleaved) TIFF without decoding it.
+
+	Output:
+
+		np.memmap of shape (height, width) or (height, width, channels) when the strips are
+		contiguous in the file, which is the common case, otherwise a TiledArray.
+
+	'''
+
+	order, tags = read_tiff_tags(path)
+	if tags.get(259, (1,))[0] != 1:
+		raise ValueError("{} is compressed and can't be memory-mapped".format(path))
+	if tags.get(284, (1,))[0] != 1:
+		raise ValueError("{} has planar samples and can't be memory-mapped".format(path))
+
+	width, height = tags[256][0], tags[257][0]
+	channels = tags.get(277, (1,))[0]
+	bits = tags.get(258, (8,))[0]
+	kind = _SAMPLE_FORMATS[tags.get(339, (1,))[0]]
+	if bits % 8:
+		raise ValueError("{} has {}-bit samples, only whole bytes are supported".format(path, bits))
+	dtype = np.dtype(order + kind + str(bits // 8))
+	shape = (height, width, channels) if channels > 1 else (height, width)
+
+	if 324 in tags:
+		return TiledArray(path, shape, dtype, tags[324], tags[322][0], tags[323][0])
+
+	offsets, counts = tags[273], tags[279]
+	rows = tags.get(278, (height,))[0]
+	contiguous = all(offsets[i] + counts[i] == offsets[i + 1] for i in range(len(offsets) - 1))
+	if contiguous:
+		return np.memmap(path, dtype=dtype, mode="r", offset=offsets[0], shape=shape)
+	return TiledArray(path, shape, dtype, offsets, width, min(rows, height))
+
+
+def tiff_header(size, channels=3, dtype=np.uint8):
+
+	'''
+
+	Builds the header and IFD of a little-endian, uncompressed, single-strip TIFF. The pixels
+	follow the returned bytes directly.
+
+	'''
+
+	width, height = size
+	dtype = np.dtype(dtype)
+	bits = 8 * dtype.itemsize
+	sample_format = {"u": 1, "i": 2, "f": 3}[dtype.kind]
+	photometric = 2 if channels >= 3 else 1
+
+	entries = [
+		(256, 4, [width]),
+		(257, 4, [height]),
+		(258, 3, [bits] * channels),
+		(259, 3, [1]),
+		(262, 3, [photometric]),
+		(273, 4, [0]),
+		(277, 3, [channels]),
+		(278, 4, [height]),
+		(279, 4, [width * height * channels * dtype.itemsize]),
+		(284, 3, [1]),
+		(339, 3, [sample_format] * channels),
+	]
+	if channels in (2, 4):
+		entries.append((338, 3, [2]))
+	entries.sort()
+
+	# Values that don't fit in an entry are stored after the IFD
+	ifd_offset = 8
+	extra_offset = ifd_offset + 2 + 12 * len(entries) + 4
+	ifd, extra = b"", b""
+	for tag, kind, values in entries:
+		packed = struct.pack("<" + _TYPES[kind] * len(values), *values)
+		if len(packed) > 4:
+			ifd += struct.pack("<HHII", tag, kind, len(values), extra_offset + len(extra))
+			extra += packed + b"\0" * (len(packed) % 2)
+		else:
+			ifd += struct.pack("<HHI", tag, kind, len(values)) + packed.ljust(4, b"\0")
+
+	# Align the pixels so the memory map can be viewed as dtype
+	data_offset = -(-(extra_offset + len(extra)) // 16) * 16
+	header = b"II" + struct.pack("<HI", 42, ifd_offset) + struct.pack("<H", len(entries)) + ifd + b"\0\0\0\0" + extra
+	header = header.ljust(data_offset, b"\0")
+
+	# Patch in the strip offset now that it is known
+	strip_entry = 8 + 2 + 12 * [tag for tag, _, _ in entries].index(273)
+	return header[:strip_entry + 8] + struct.pack("<I", data_offset) + header[strip_entry + 12:]
+
+
+def create_tiff(path, size, channels=3, dtype=np.uint8):
+
+	'''
+
+	Creates an uncompressed TIFF of the given size and returns a writable memory map of its
+	pixels, of shape (height, width) or (height, width, channels).
+
+	'''
+
+	width, height = size
+	header = tiff_header(size, channels, dtype)
+	nbytes = width * height * channels * np.dtype(dtype).itemsize
+	with open(path, "wb") as f:
+		f.write(header)
+		f.truncate(len(header) + nbytes)
+	shape = (height, width, channels) if channels > 1 else (height, width)
+	return np.memmap(path, dtype=dtype, mode="r+", offset=len(header), shape=shape)
+
+
+def open_image(path, shape=None, dtype=np.uint8, offset=0):
+
+	'''
+
+	Memory-maps a TIFF, or a raw file when its shape is given.
+
+	'''
+
+	if shape is not None:
+		return open_raw(path, shape, dtype, offset)
+	return open_tiff(path)
+
+
+def warp_file(source_path, output_path, coeffs, size=None, band_height=256, **raw):
+
+	'''
+
+	Warps a memory-mapped source straight into a memory-mapped TIFF output, one band of rows
+	at a time, without materializing either image in private memory.
+
+	Input:
+
+		source_path = str, uncompressed TIFF, or raw file described by shape, dtype and offset.
+		output_path = str, TIFF file to create.
+		coeffs = np.array([c0, ..., c7]), perspective coefficients.
+		size = (width, height) of the output, defaults to the size of the source.
+
+	'''
+
+	from perspectivewarp import warp
+
+	source = open_image(source_path, **raw)
+	height, width = source.shape[:2]
+	size = size or (width, height)
+	channels = source.shape[2] if len(source.shape) > 2 else 1
+	out = create_tiff(output_path, size, channels, source.dtype.newbyteorder("<"))
+	warp(source, coeffs, size, out=out, band_height=band_height)
+	out.flush()
+	return out
+
+
+class PNGWriter (object):
+
+	'''
+
+	Writes a PNG one band of rows at a time, so the image never has to be held in memory.
+
+	Input:
+
+		file = str or binary file object, which may be non-seekable (a socket, a pipe, ...).
+		size = (width, height) of the image.
+		channels = 1 (gray), 2 (gray and alpha), 3 (RGB) or 4 (RGBA).
+		dtype = np.uint8 or np.uint16.
+		level = int, zlib compression level.
+
+	'''
+
+	def __init__(self, file, size, channels=3, dtype=np.uint8, level=6):
+		if np.dtype(dtype) not in (np.uint8, np.uint16):
+			raise ValueError("PNG samples must be uint8 or uint16, not {}".format(np.dtype(dtype)))
+		self.file = open(file, "wb") if isinstance(file, (str, os.PathLike)) else file
+		self.owns_file = self.file is not file
+		self.width, self.height = size
+		self.channels = channels
+		self.dtype = np.dtype(dtype).newbyteorder(">")
+		self.compressor = zlib.compressobj(level)
+		self.rows = 0
+
+		color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+		self.file.write(b"\x89PNG\r\n\x1a\n")
+		self.chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8 * self.dtype.itemsize, color_type, 0, 0, 0))
+
+
+	def chunk(self, kind, data):
+		self.file.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+	def write(self, rows):
+
+		'''
+
+		Appends rows, an array of shape (n, width) or (n, width, channels).
+
+		'''
+
+		rows = np.asarray(rows, dtype=self.dtype).reshape(len(rows), -1).view(np.uint8)
+
+		# Sub filter: each byte minus the same byte of the previous pixel
+		bpp = self.channels * self.dtype.itemsize
+		filtered = np.empty((len(rows), rows.shape[1] + 1), dtype=np.uint8)
+		filtered[:, 0] = 1
+		filtered[:, 1:bpp + 1] = rows[:, :bpp]
+		np.subtract(rows[:, bpp:], rows[:, :-bpp], out=filtered[:, bpp + 1:])
+
+		data = self.compressor.compress(filtered.tobytes())
+		if data:
+			self.chunk(b"IDAT", data)
+		self.rows += len(rows)
+
+
+	def close(self):
+		if self.rows != self.height:
+			raise ValueError("{} rows written, expected {}".format(self.rows, self.height))
+		self.chunk(b"IDAT", self.compressor.flush())
+		self.chunk(b"IEND", b"")
+		if self.owns_file:
+			self.file.close()
+
+
+
+class TIFFWriter (object):
+
+	'''
+
+	Writes an uncompressed TIFF one band of rows at a time. The header is written first, so
+	the file can also be streamed to a non-seekable file object.
+
+	'''
+
+	def __init__(self, file, size, channels=3, dtype=np.uint8):
+		self.file = open(file, "wb") if isinstance(file, (str, os.PathLike)) else file
+		self.owns_file = self.file is not file
+		self.width, self.height = size
+		self.dtype = np.dtype(dtype).newbyteorder("<")
+		self.rows = 0
+		self.file.write(tiff_header(size, channels, self.dtype))
+
+
+	def write(self, rows):
+		self.file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+		self.rows += len(rows)
+
+
+	def close(self):
+		if self.rows != self.height:
+			raise ValueError("{} rows written, expected {}".format(self.rows, self.height))
+		if self.owns_file:
+			self.file.close()
+
+
+
+def warp_to_file(source, coeffs, size, file, format="PNG", band_height=64, camera=None):
+
+	'''
+
+	Warps source and encodes the result while it is being rendered: each band of rows is
+	handed to a streaming writer as soon as it is done, so the first bytes go out right away
+	and memory use is bounded by band_height instead of the size of the output.
+
+	Input:
+
+		source = PIL.Image or np.array.
+		coeffs = np.array([c0, ..., c7]), perspective coefficients.
+		size = (width, height) of the output.
+		file = str or binary file object.
+		format = "PNG" or "TIFF".
+		band_height = int, number of rows rendered and written at a time.
+		camera = perspectivelens.Camera, lens distortion of the source.
+
+	'''
+
+	from perspectivewarp import iter_bands
+
+	source = np.asarray(source)
+	channels = source.shape[2] if source.ndim > 2 else 1
+	writer = {"PNG": PNGWriter, "TIFF": TIFFWriter}[format.upper()](file, size, channels, source.dtype)
+	for top, band in iter_bands(source, coeffs, size, band_height, camera=camera):
+		writer.write(band)
+	writer.close()
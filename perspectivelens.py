@@ -0,0 +1,187 @@
+import numpy as np
+
+
+# Lens distortion. Phone and wide-angle captures bend straight lines, which moves the
+# vanishing points found by intersect and therefore the focal distance and the coefficients.
+# A Camera describes the distortion with the Brown-Conrady model (radial k1, k2, k3 and
+# tangential p1, p2). It is used in two places: the annotated lines are undistorted before the
+# geometry is solved (see find_persp_coeffs_from_lines), and the distortion is folded into the
+# per-pixel coordinate map of the warp (see perspectivewarp.coordinate_map), so the image is
+# only resampled once.
+#
+# Coordinates follow Image.transform, with pixel centers at (x + 0.5, y + 0.5).
+
+
+class Camera (object):
+
+	'''
+
+	Brown-Conrady distortion of a camera.
+
+	Input:
+
+		size = (width, height) of the images taken with the camera.
+		k1, k2, k3 = floats, radial coefficients. Negative k1 is barrel distortion.
+		p1, p2 = floats, tangential coefficients.
+		center = (x, y), center of distortion, defaults to the center of the image.
+		focal = float, length in pixels that normalizes the coordinates, defaults to half the
+			diagonal of the image so that r = 1 in the corners. Use the focal length in pixels
+			when the coefficients come from a calibration.
+
+	'''
+
+	def __init__(self, size, k1=0.0, k2=0.0, k3=0.0, p1=0.0, p2=0.0, center=None, focal=None):
+		width, height = size
+		self.size = (width, height)
+		self.k1, self.k2, self.k3 = k1, k2, k3
+		self.p1, self.p2 = p1, p2
+		self.center = np.array(center if center is not None else (width/2, height/2), dtype=np.float64)
+		self.focal = float(focal) if focal is not None else 0.5 * np.hypot(width, height)
+
+
+	def __repr__(self):
+		return "Camera({}, k1={:g}, k2={:g}, k3={:g}, p1={:g}, p2={:g})".format(
+			self.size, self.k1, self.k2, self.k3, self.p1, self.p2)
+
+
+	def shift(self, x, y):
+
+		# Deviation of the distorted point from the ideal one, in normalized coordinates
+		r2 = x * x + y * y
+		radial = (self.k1 + (self.k2 + self.k3 * r2) * r2) * r2
+		dx = x * radial + 2 * self.p1 * x * y + self.p2 * (r2 + 2 * x * x)
+		dy = y * radial + self.p1 * (r2 + 2 * y * y) + 2 * self.p2 * x * y
+		return dx, dy
+
+
+	def jacobian(self, x, y):
+
+		# Derivatives of the distorted normalized point with respect to the ideal one
+		r2 = x * x + y * y
+		radial = (self.k1 + (self.k2 + self.k3 * r2) * r2) * r2
+		slope = self.k1 + (2 * self.k2 + 3 * self.k3 * r2) * r2
+		cross = 2 * x * y * slope + 2 * self.p1 * x + 2 * self.p2 * y
+		xx = 1 + radial + 2 * x * x * slope + 2 * self.p1 * y + 6 * self.p2 * x
+		yy = 1 + radial + 2 * y * y * slope + 6 * self.p1 * y + 2 * self.p2 * x
+		return xx, cross, yy
+
+
+	def distort(self, x, y):
+
+		'''
+
+		Maps ideal (undistorted) pixel coordinates to where they appear in the image. x and y
+		are arrays of any (matching) shape.
+
+		'''
+
+		cx, cy = self.center
+		f = self.focal
+		xn, yn = (x - cx) / f, (y - cy) / f
+		dx, dy = self.shift(xn, yn)
+		return x + f * dx, y + f * dy
+
+
+	def undistort(self, x, y, iterations=6):
+
+		'''
+
+		Maps pixel coordinates in the image to ideal ones. The model has no closed form
+		inverse, so it is inverted with a few Newton steps. Points that no ideal point is
+		distorted to (beyond the fold of a strong barrel distortion) come out as nan.
+
+		'''
+
+		cx, cy = self.center
+		f = self.focal
+		xd = (np.asarray(x, dtype=np.float64) - cx) / f
+		yd = (np.asarray(y, dtype=np.float64) - cy) / f
+		xn, yn = xd, yd
+		with np.errstate(invalid="ignore", over="ignore", divide="ignore"):
+			for _ in range(iterations):
+				dx, dy = self.shift(xn, yn)
+				ex, ey = xn + dx - xd, yn + dy - yd
+				a, b, d = self.jacobian(xn, yn)
+				det = a * d - b * b
+				xn, yn = xn - (d * ex - b * ey) / det, yn - (a * ey - b * ex) / det
+
+			# Only keep points that converged on the monotonic side of the model
+			dx, dy = self.shift(xn, yn)
+			a, b, d = self.jacobian(xn, yn)
+			bad = (np.hypot(xn + dx - xd, yn + dy - yd) > 1e-9) | (a * d - b * b <= 0)
+		xn, yn = np.where(bad, np.nan, xn), np.where(bad, np.nan, yn)
+		return xn * f + cx, yn * f + cy
+
+
+	def undistort_lines(self, lines):
+
+		'''
+
+		Undistorts the endpoints of lines given as in find_persp_coeffs_from_lines.
+
+		'''
+
+		points = np.asarray(lines, dtype=np.float64)
+		x, y = self.undistort(points[..., 0], points[..., 1])
+		return [[(px, py) for px, py in zip(*line)] for line in zip(x.tolist(), y.tolist())]
+
+
+
+def straightness(polylines, camera):
+
+	'''
+
+	Measures how far polylines that should be straight are from straight lines once undistorted
+	by camera, as the RMS distance of their points to the best fitting lines, relative to the
+	length of each polyline.
+
+	'''
+
+	residuals = []
+	for points in polylines:
+		points = np.asarray(points, dtype=np.float64)
+		x, y = camera.undistort(points[:, 0], points[:, 1])
+		if not np.all(np.isfinite(x) & np.isfinite(y)):
+			return np.inf
+		p = np.stack((x, y), axis=-1)
+		p = p - p.mean(axis=0)
+		smallest = np.linalg.eigvalsh(p.T @ p / len(p))[0]
+		length = np.linalg.norm(p[-1] - p[0])
+		residuals.append(max(smallest, 0) / length ** 2)
+	return np.sqrt(np.mean(residuals))
+
+
+def estimate_k1(polylines, size, center=None, focal=None, limit=0.5, steps=41, refinements=3):
+
+	'''
+
+	Estimates the radial coefficient k1 from the curvature of annotated segments. Each
+	polyline holds three or more points clicked along an edge that is straight in the scene,
+	e.g. the endpoints of an annotated line and a few points in between.
+
+	Input:
+
+		polylines = [[(x1, y1), (x2, y2), (x3, y3), ...], ...], points along straight edges.
+		size, center, focal = as in Camera.
+		limit = float, k1 is searched in [-limit, limit].
+		steps = int, number of values of k1 tried in each round.
+		refinements = int, number of times the search is narrowed around the best value.
+
+	Output:
+
+		Camera with the estimated k1.
+
+	'''
+
+	polylines = [p for p in polylines if len(p) >= 3]
+	if not polylines:
+		raise ValueError("estimating k1 needs polylines with at least three points")
+
+	low, high = -limit, limit
+	for _ in range(refinements + 1):
+		candidates = np.linspace(low, high, steps)
+		costs = [straightness(polylines, Camera(size, k1, center=center, focal=focal)) for k1 in candidates]
+		best = int(np.argmin(costs))
+		step = candidates[1] - candidates[0]
+		low, high = candidates[best] - step, candidates[best] + step
+	return Camera(size, float(candidates[best]), center=center, focal=focal)
@@ -0,0 +1,340 @@
+import numpy as np
+from perspectivecorrection import _rectify_planes, find_perspective_coeffs_batch, _to_matrix, _to_coeffs
+from perspectivewarp import coordinate_map, remap, halve
+
+
+# Stitches several overlapping shots of the same plane (facades, murals, whiteboards) into
+# one corrected mosaic. Each shot is rectified onto a common plane using its own lines, the
+# in-plane offset between neighbouring shots is estimated by normalized cross correlation of
+# small renders over their overlap, and the mosaic is then rendered straight from the
+# sources, one band of rows at a time, optionally streamed to a PNG file.
+
+
+def _translation(s, t):
+	return np.array([[s, 0, t[0]], [0, s, t[1]], [0, 0, 1]], dtype=np.float64)
+
+
+def _luma(pixels):
+	pixels = pixels.astype(np.float32)
+	if pixels.ndim == 3:
+		pixels = pixels[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)[:pixels.shape[2]]
+	return pixels
+
+
+def _rgb(pixels):
+	if pixels.ndim == 2:
+		return np.repeat(pixels[..., None], 3, axis=-1)
+	return pixels[..., :3]
+
+
+def masked_correlation(a, mask_a, b, mask_b, min_overlap=0.05):
+
+	'''
+
+	Finds the translation t such that b(x) best matches a(x + t), using the normalized cross
+	correlation over the overlap of the valid pixels of both images at every shift. All shifts
+	are evaluated at once with FFTs, and images are zero padded so that shifts don't wrap around.
+
+	Input:
+
+		a, b = np.arrays of shape (height, width), grayscale images.
+		mask_a, mask_b = boolean np.arrays, valid pixels of a and b.
+		min_overlap = float, smallest overlap considered, as a fraction of the smaller image.
+
+	Output:
+
+		np.array([tx, ty]).
+
+	'''
+
+	shape = (a.shape[0] + b.shape[0], a.shape[1] + b.shape[1])
+	fft = lambda x: np.fft.rfft2(x, shape)
+	corr = lambda F, G: np.fft.irfft2(F * np.conj(G), shape)
+
+	ma, mb = mask_a.astype(np.float64), mask_b.astype(np.float64)
+	a, b = a * ma, b * mb
+	Ma, Mb, A, B = fft(ma), fft(mb), fft(a), fft(b)
+
+	n = np.round(corr(Ma, Mb))
+	sum_a, sum_b = corr(A, Mb), corr(Ma, B)
+	cross = corr(A, B) - sum_a * sum_b / np.maximum(n, 1)
+	var_a = corr(fft(a * a), Mb) - sum_a ** 2 / np.maximum(n, 1)
+	var_b = corr(Ma, fft(b * b)) - sum_b ** 2 / np.maximum(n, 1)
+
+	minimum = min_overlap * min(ma.sum(), mb.sum())
+	with np.errstate(invalid="ignore", divide="ignore"):
+		score = np.where((n >= minimum) & (var_a > 0) & (var_b > 0), cross / np.sqrt(var_a * var_b), -np.inf)
+
+	# Shifts range from -(b.shape - 1) to a.shape - 1, negative ones wrap past a.shape
+	y, x = np.unravel_index(np.argmax(score), shape)
+	if y >= a.shape[0]:
+		y -= shape[0]
+	if x >= a.shape[1]:
+		x -= shape[1]
+	return np.array((x, y), dtype=np.float64)
+
+
+
+class Mosaic (object):
+
+	'''
+
+	Mosaic of shots of the same plane.
+
+	Input:
+
+		shots = [(image, horizontal_lines, vertical_lines), ...] or with a sensor as fourth
+			element, ordered so that consecutive shots overlap. image is a path, a PIL.Image or
+			an np.array (possibly memory-mapped, see perspectiveio). Each band only reads the part
+			of a shot it covers, so paths and memory maps keep memory bounded however many
+			shots there are.
+		normalize = "height", "width" or None. The annotated rectangles are scaled to a common
+			height (or width) on the plane, e.g. when each shot's lines follow the same two
+			floor lines of a facade. With None, each shot keeps its own corrected scale.
+		coarse_height = int, height in pixels of the reference rectangle in the coarse renders
+			used to align the shots.
+
+	'''
+
+	def __init__(self, shots, normalize="height", coarse_height=192):
+
+		self.images, self.sizes = [], []
+		lines, sensors = [], []
+		for shot in shots:
+			image, horizontal_lines, vertical_lines = shot[:3]
+			if isinstance(image, str):
+				from PIL import Image
+				with Image.open(image) as opened:
+					width, height = opened.size
+			elif hasattr(image, "size") and not isinstance(image, np.ndarray):
+				width, height = image.size
+			else:
+				height, width = image.shape[:2]
+			sensor = shot[3] if len(shot) > 3 else np.array([[width/2, height/2, 0]])
+			self.images.append(image)
+			self.sizes.append((width, height))
+			lines.append([*horizontal_lines, *vertical_lines])
+			sensors.append(np.asarray(sensor, dtype=np.float64).reshape(3))
+
+		# Solve every shot in one batched call
+		rect, quad, focal_distance = _rectify_planes(np.array(lines, dtype=np.float64), np.array(sensors))
+		H = _to_matrix(find_perspective_coeffs_batch(rect, quad))
+		for i in range(len(lines)):
+			if not (np.isfinite(focal_distance[i]) and np.all(np.isfinite(H[i]))):
+				raise ValueError("the lines of shot {} don't define a real focal distance".format(i))
+
+		low, high = rect.min(axis=1), rect.max(axis=1)
+		extent = high - low
+		axis = {"width": 0, "height": 1}.get(normalize)
+		scales = extent[0, axis] / extent[:, axis] if axis is not None else np.ones(len(shots))
+
+		# G maps plane coordinates of a shot (its rectangle starting at the origin) to its source
+		self.G = [H[i] @ _translation(1 / scales[i], low[i]) for i in range(len(shots))]
+		self.rects = [np.array([[0, 0], extent[i] * scales[i]]) for i in range(len(shots))]
+		self.scales = scales
+		self.reference = extent[0] * scales[0]
+		self.footprints = [self.footprint(i) for i in range(len(shots))]
+		self.coarse = coarse_height / self.reference[1]
+		self.offsets = self.align()
+
+
+	def footprint(self, i):
+
+		'''
+
+		Box (left, top, right, bottom) of the plane covered by shot i, limited to a margin
+		around its rectangle so that views close to the horizon stay bounded.
+
+		'''
+
+		width, height = self.sizes[i]
+		corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]], dtype=np.float64)
+		p = corners @ np.linalg.inv(self.G[i]).T
+		(x0, y0), (x1, y1) = self.rects[i]
+		margin = max(x1 - x0, y1 - y0)
+		box = np.array([x0 - margin, y0 - margin, x1 + margin, y1 + margin])
+		if np.all(p[:, 2] > 0):
+			p = p[:, :2] / p[:, 2:]
+			box = np.array([max(box[0], p[:, 0].min()), max(box[1], p[:, 1].min()),
+				min(box[2], p[:, 0].max()), min(box[3], p[:, 1].max())])
+		return box
+
+
+	def level(self, i, scale):
+
+		# Power of two k such that shot i downscaled by 2 ** k roughly matches scale output
+		# pixels per plane unit
+		width, height = self.sizes[i]
+		k = int(np.floor(np.log2(1 / (self.scales[i] * scale)))) if self.scales[i] * scale < 1 else 0
+		return min(k, max(int(np.log2(min(width, height))) - 1, 0))
+
+
+	def load(self, i, k, region):
+
+		'''
+
+		Reads shot i downscaled by 2 ** k over region (left, top, right, bottom), given in pixels
+		of that level. Only that part of an array or memory map is read. Files are opened again
+		for every region, and JPEGs are decoded at a reduced size when k allows it.
+
+		'''
+
+		f = 2 ** k
+		x0, y0, x1, y1 = [f * v for v in region]
+		image = self.images[i]
+		if isinstance(image, np.ndarray):
+			level = image[y0:y1, x0:x1]
+			for _ in range(k):
+				level = halve(level)
+			return level
+
+		from PIL import Image
+		opened = Image.open(image) if isinstance(image, str) else image
+		try:
+			r = 1
+			if opened is not image and k:
+				width, height = self.sizes[i]
+				opened.draft("L" if opened.mode == "L" else "RGB", (width // f, height // f))
+				r = 2 ** int(round(np.log2(width / opened.size[0])))
+			crop = opened.crop((x0 // r, y0 // r, x1 // r, y1 // r))
+			crop = crop if crop.mode in ("L", "RGB") else crop.convert("RGB")
+			return np.asarray(crop.reduce(f // r) if f > r else crop)
+		finally:
+			if opened is not image:
+				opened.close()
+
+
+	def render_shot(self, i, scale, box):
+
+		'''
+
+		Renders shot i on its own plane at scale output pixels per plane unit, over box given
+		in output pixels (its origin may be fractional). Returns (pixels, valid).
+
+		'''
+
+		k = self.level(i, scale)
+		D = np.diag([0.5 ** k, 0.5 ** k, 1])
+		M = D @ self.G[i] @ _translation(1 / scale, (box[0] / scale, box[1] / scale))
+		size = (int(round(box[2] - box[0])), int(round(box[3] - box[1])))
+		map_x, map_y = coordinate_map(_to_coeffs(M), (0, 0, *size))
+		width, height = self.sizes[i][0] >> k, self.sizes[i][1] >> k
+		valid = (map_x > -0.5) & (map_x < width - 0.5) & (map_y > -0.5) & (map_y < height - 0.5)
+		if not valid.any():
+			return np.zeros((size[1], size[0], 3), dtype=np.uint8), valid
+
+		# Only the part of the level that the box maps to is read, with a margin for interpolation
+		x0, y0 = int(max(np.floor(map_x[valid].min()) - 2, 0)), int(max(np.floor(map_y[valid].min()) - 2, 0))
+		x1, y1 = int(min(np.ceil(map_x[valid].max()) + 3, width)), int(min(np.ceil(map_y[valid].max()) + 3, height))
+		source = self.load(i, k, (x0, y0, x1, y1))
+		return _rgb(remap(source, map_x - x0, map_y - y0)), valid
+
+
+	def align(self):
+
+		'''
+
+		Estimates the offset of every shot in the mosaic from the overlap with its predecessor,
+		at the coarse scale.
+
+		'''
+
+		c = self.coarse
+		renders = []
+		for i in range(len(self.images)):
+			box = np.round(self.footprints[i] * c).astype(int)
+			pixels, valid = self.render_shot(i, c, tuple(box))
+			renders.append((_luma(pixels), valid, box[:2] / c))
+
+		offsets = [np.zeros(2)]
+		for i in range(1, len(renders)):
+			(a, mask_a, origin_a), (b, mask_b, origin_b) = renders[i - 1], renders[i]
+			t = masked_correlation(a, mask_a, b, mask_b)
+			offsets.append(offsets[-1] + t / c + origin_a - origin_b)
+		return offsets
+
+
+	def bounds(self):
+		boxes = np.array([f + np.tile(o, 2) for f, o in zip(self.footprints, self.offsets)])
+		return np.array([boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
+
+
+	def render(self, file=None, scale=1.0, band_height=128):
+
+		'''
+
+		Renders the mosaic in bands of rows directly from the sources, blending overlapping
+		shots with weights that fade out towards the edge of each shot.
+
+		Input:
+
+			file = str or binary file object to stream a PNG to, or None to return an array.
+			scale = float, output pixels per plane unit (the reference rectangle has the height,
+				or width, of the first shot's corrected rectangle).
+			band_height = int, number of rows rendered at a time.
+
+		Output:
+
+			np.array of the mosaic, or the size (width, height) of the PNG written to file.
+
+		'''
+
+		from perspectiveio import PNGWriter
+
+		left, top, right, bottom = self.bounds() * scale
+		width, height = int(np.ceil(right - left)), int(np.ceil(bottom - top))
+		writer = PNGWriter(file, (width, height), 3) if file is not None else None
+		mosaic = np.empty((height, width, 3), dtype=np.uint8) if file is None else None
+
+		# Output pixel (u, v) of shot i is at plane (u + left) / scale - offset_i
+		boxes = [np.floor((f + np.tile(o, 2)) * scale - np.tile((left, top), 2)).astype(int) for f, o in zip(self.footprints, self.offsets)]
+
+		for band_top in range(0, height, band_height):
+			band_bottom = min(band_top + band_height, height)
+			acc = np.zeros((band_bottom - band_top, width, 3), dtype=np.float32)
+			weight = np.zeros((band_bottom - band_top, width), dtype=np.float32)
+
+			for i, (x0, y0, x1, y1) in enumerate(boxes):
+				box = (max(x0, 0), max(y0, band_top), min(x1, width), min(y1, band_bottom))
+				if box[0] >= box[2] or box[1] >= box[3]:
+					continue
+
+				# Shift the box into the shot's own output frame
+				shift = np.array((left, top)) - self.offsets[i] * scale
+				shot_box = (box[0] + shift[0], box[1] + shift[1], box[2] + shift[0], box[3] + shift[1])
+				pixels, valid = self.render_shot(i, scale, shot_box)
+
+				# Feather: weight grows with the distance to the edge of the shot's footprint
+				u = np.arange(box[0], box[2]) + 0.5
+				v = np.arange(box[1], box[3])[:, None] + 0.5
+				w = np.minimum(np.minimum(u - x0, x1 - u), np.minimum(v - y0, y1 - v)).astype(np.float32)
+				w = np.maximum(w, 1e-3) * valid
+
+				rows = slice(box[1] - band_top, box[3] - band_top)
+				cols = slice(box[0], box[2])
+				acc[rows, cols] += pixels * w[..., None]
+				weight[rows, cols] += w
+
+			band = np.where(weight[..., None] > 0, acc / np.maximum(weight, 1e-6)[..., None], 0)
+			band = np.clip(np.rint(band), 0, 255).astype(np.uint8)
+			if writer:
+				writer.write(band)
+			else:
+				mosaic[band_top:band_bottom] = band
+
+		if writer:
+			writer.close()
+			return width, height
+		return mosaic
+
+
+
+def build_mosaic(shots, file=None, scale=1.0, band_height=128, **options):
+
+	'''
+
+	Aligns shots (see Mosaic) and renders the mosaic, to file if given.
+
+	'''
+
+	return Mosaic(shots, **options).render(file, scale, band_height)
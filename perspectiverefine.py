@@ -0,0 +1,140 @@
+import numpy as np
+from perspectivecorrection import find_persp_coeffs_from_lines
+
+
+# Refinement of hand-placed lines. Each segment is snapped to the strongest straight edge near
+# it by moving its two endpoints along the segment's normal. The search runs coarse to fine:
+# at each level the edge strength is measured with box filters as wide as the step, which
+# acts as a pyramid level, and the endpoints are searched on a small grid of steps around the
+# current estimate before the step is halved. Only pixels along the candidate lines are read,
+# so the cost does not depend on the size of the image.
+
+
+def _sample(image, x, y):
+
+	'''
+
+	Bilinearly samples the luma of image at (x, y), clamping at the border.
+
+	'''
+
+	height, width = image.shape[:2]
+	x = np.clip(x - 0.5, 0, width - 1)
+	y = np.clip(y - 0.5, 0, height - 1)
+	x0, y0 = np.minimum(x.astype(np.intp), width - 2), np.minimum(y.astype(np.intp), height - 2)
+	fx, fy = x - x0, y - y0
+	if image.ndim == 3:
+		weights = np.array([0.299, 0.587, 0.114], dtype=np.float32)[:image.shape[2]]
+		at = lambda j, i: image[j, i, :3].astype(np.float32) @ weights
+	else:
+		at = lambda j, i: image[j, i].astype(np.float32)
+	top = at(y0, x0) * (1 - fx) + at(y0, x0 + 1) * fx
+	bottom = at(y0 + 1, x0) * (1 - fx) + at(y0 + 1, x0 + 1) * fx
+	return top * (1 - fy) + bottom * fy
+
+
+def edge_strength(image, p, q, a, b, scale, samples=64, margin=0.1):
+
+	'''
+
+	Measures how well the lines from p + a n to q + b n (n the unit normal of pq) follow an
+	edge, for arrays of endpoint offsets a and b. The edge is the difference between the mean
+	luma on either side of the line over a band scale pixels wide, averaged along the line.
+	Polarity must be consistent along the line, so texture and noise cancel out.
+
+	'''
+
+	p, q = np.asarray(p, dtype=np.float64), np.asarray(q, dtype=np.float64)
+	direction = (q - p) / np.linalg.norm(q - p)
+	n = np.array([-direction[1], direction[0]])
+
+	# Positions along the line, away from the ends where other edges usually meet it
+	t = np.linspace(margin, 1 - margin, samples)
+	offset = (1 - t) * np.asarray(a, dtype=np.float64)[..., None] + t * np.asarray(b, dtype=np.float64)[..., None]
+	base = p + t[:, None] * (q - p)
+
+	# Box filter across the line: m samples on each side, spread over scale pixels
+	m = int(min(max(np.ceil(scale), 1), 4))
+	u = (np.arange(m) + 0.5) * max(scale, 1) / m
+	u = np.concatenate((-u[::-1], u))
+	points = base[:, None] + (offset[..., None] + u)[..., None] * n
+	values = _sample(image, points[..., 0], points[..., 1])
+	contrast = values[..., m:].mean(axis=-1) - values[..., :m].mean(axis=-1)
+	return np.abs(contrast.mean(axis=-1))
+
+
+def refine_line(image, line, search=16, min_step=0.25, samples=64):
+
+	'''
+
+	Snaps a line to the strongest nearby edge.
+
+	Input:
+
+		image = np.array of shape (height, width) or (height, width, channels), or PIL.Image.
+		line = [(x1, y1), (x2, y2)], the hand-placed line.
+		search = float, largest distance in pixels each endpoint may move.
+		min_step = float, precision in pixels of the final level.
+		samples = int, number of positions sampled along the line.
+
+	Output:
+
+		[(x1, y1), (x2, y2)], the refined line, with each endpoint moved along the normal.
+
+	'''
+
+	image = np.asarray(image)
+	p, q = np.asarray(line[0], dtype=np.float64), np.asarray(line[1], dtype=np.float64)
+	length = np.linalg.norm(q - p)
+	if length < 4:
+		return [tuple(p), tuple(q)]
+	n = np.array([p[1] - q[1], q[0] - p[0]]) / length
+
+	# Each level searches a 5 x 5 grid of endpoint offsets spaced by step around the current
+	# ones, so the first level covers +-search and later levels refine within +-2 steps
+	a, b = 0.0, 0.0
+	step = search / 2
+	grid = np.arange(-2, 3)
+	while step >= min_step:
+		ga, gb = np.meshgrid(a + step * grid, b + step * grid, indexing="ij")
+		inside = (np.abs(ga) <= search) & (np.abs(gb) <= search)
+		score = edge_strength(image, p, q, ga, gb, step, samples)
+		score[~inside] = -1
+		i, j = np.unravel_index(np.argmax(score), score.shape)
+		a, b = ga[i, j], gb[i, j]
+		step /= 2
+
+	return [tuple(map(float, p + a * n)), tuple(map(float, q + b * n))]
+
+
+def refine_lines(image, horizontal_lines, vertical_lines, **options):
+
+	'''
+
+	Refines the lines given as in find_persp_coeffs_from_lines, see refine_line.
+
+	'''
+
+	image = np.asarray(image)
+	return ([refine_line(image, line, **options) for line in horizontal_lines],
+		[refine_line(image, line, **options) for line in vertical_lines])
+
+
+def refine_coeffs(image, horizontal_lines, vertical_lines, sensor=None, **options):
+
+	'''
+
+	Refines the lines and solves for the perspective coefficients again.
+
+	Output:
+
+		(coeffs, horizontal_lines, vertical_lines), with the refined lines.
+
+	'''
+
+	image = np.asarray(image)
+	if sensor is None:
+		height, width = image.shape[:2]
+		sensor = np.array([[width/2, height/2, 0]])
+	horizontal_lines, vertical_lines = refine_lines(image, horizontal_lines, vertical_lines, **options)
+	return find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor), horizontal_lines, vertical_lines
@@ -0,0 +1,518 @@
+import io
+import os
+import csv
+import json
+import time
+import base64
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import numpy as np
+
+
+# Local correction service. Requests are plain HTTP/1.1 over TCP or a Unix socket:
+#
+#   POST /coeffs   {"lines": [h1, h2, v1, v2], "size": [w, h]}  ->  {"coeffs": [c0, ..., c7]}
+#   POST /correct  {"lines": ..., "path": "..."} or {"lines": ..., "image": "<base64>"}
+#                  ->  corrected image, streamed back with chunked transfer encoding
+#   GET  /metrics  ->  request counts, admission counters and latency percentiles
+#
+# Each line is [[x1, y1], [x2, y2]]. "sensor": [x, y, z] can replace "size", otherwise the
+# sensor is placed at the center of the image. The work runs in a pool of processes started
+# (and warmed up) before the server accepts connections, and /coeffs requests arriving
+# close together are solved in a single batched call. Lines that don't define a real focal
+# distance are answered with 422.
+
+
+def _warm_up():
+
+	# Runs once in each worker so the first real request doesn't pay for imports and caches
+	from PIL import Image
+	import perspectivecorrection
+
+	lines = [[(0, 0), (10, 1)], [(0, 10), (10, 9)], [(0, 0), (1, 10)], [(10, 1), (9, 9)]]
+	perspectivecorrection.find_persp_coeffs_from_planes([(lines[:2], lines[2:])], np.array([[5, 5, 0]]))
+	Image.new("RGB", (8, 8)).transform((8, 8), Image.PERSPECTIVE, (1, 0, 0, 0, 1, 0, 0, 0), Image.BICUBIC)
+	return os.getpid()
+
+
+def _solve_batch(lines, sensors):
+
+	'''
+
+	Solves the perspective coefficients for a batch of requests in one vectorized call.
+
+	Input:
+
+		lines = list of N line sets [h1, h2, v1, v2].
+		sensors = list of N sensors [x, y, z].
+
+	Output:
+
+		list of N lists of coefficients.
+
+	'''
+
+	from perspectivecorrection import _rectify_planes, find_perspective_coeffs_batch
+
+	rect, quad, _ = _rectify_planes(np.array(lines, dtype=np.float64), np.array(sensors, dtype=np.float64))
+	return find_perspective_coeffs_batch(rect, quad).tolist()
+
+
+def _parse(request):
+
+	'''
+
+	Validates the lines and sensor of a request body before it is batched, so that a malformed
+	request fails on its own. Returns (lines, sensor), sensor being None when the request gives
+	neither "sensor" nor "size".
+
+	'''
+
+	lines = np.asarray(request["lines"], dtype=np.float64)
+	if lines.shape != (4, 2, 2) or not np.all(np.isfinite(lines)):
+		raise ValueError("lines must be 4 lines of 2 points [x, y]")
+	sensor = request.get("sensor")
+	if sensor is None and "size" in request:
+		width, height = np.asarray(request["size"], dtype=np.float64)
+		sensor = [width/2, height/2, 0]
+	if sensor is not None:
+		sensor = np.asarray(sensor, dtype=np.float64)
+		if sensor.shape != (3,) or not np.all(np.isfinite(sensor)):
+			raise ValueError("sensor must be [x, y, z]")
+		sensor = sensor.tolist()
+	return [[tuple(p) for p in line] for line in lines.tolist()], sensor
+
+
+def _correct(source, lines, sensor, fmt):
+
+	'''
+
+	Corrects a single image and returns it encoded, along with the coefficients used.
+	source is either a path or the encoded image bytes. The image is None when the
+	coefficients are not finite.
+
+	'''
+
+	from PIL import Image
+	from perspectivecorrection import find_persp_coeffs_from_lines
+
+	image = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+	width, height = image.size
+	sensor = np.array([sensor if sensor is not None else [width/2, height/2, 0]], dtype=np.float64)
+	coeffs = find_persp_coeffs_from_lines(lines[:2], lines[2:], sensor)
+	if not np.all(np.isfinite(coeffs)):
+		return None, list(coeffs)
+	corrected_image = image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BICUBIC)
+	with io.BytesIO() as bIO:
+		corrected_image.save(bIO, fmt)
+		return bIO.getvalue(), list(coeffs)
+
+
+class LatencyTracker (object):
+
+	'''
+
+	Keeps the latencies of the most recent requests for each route.
+
+	'''
+
+	def __init__(self, window=10000):
+		self.window = window
+		self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=self.window))
+		self.counts = collections.Counter()
+
+
+	def record(self, route, status, seconds):
+		self.latencies[route].append(seconds)
+		self.counts[(route, status)] += 1
+
+
+	def summary(self):
+		result = {}
+		for route, samples in self.latencies.items():
+			ms = 1000 * np.array(samples)
+			result[route] = {
+				"count": sum(n for (r, _), n in self.counts.items() if r == route),
+				"status": {str(s): n for (r, s), n in self.counts.items() if r == route},
+				"p50_ms": float(np.percentile(ms, 50)),
+				"p90_ms": float(np.percentile(ms, 90)),
+				"p99_ms": float(np.percentile(ms, 99)),
+				"max_ms": float(ms.max()),
+			}
+		return result
+
+
+
+class CoeffBatcher (object):
+
+	'''
+
+	Collects coefficient-only requests for up to max_delay seconds (or max_batch requests)
+	and sends them to the pool as a single batch.
+
+	'''
+
+	def __init__(self, server, max_batch=256, max_delay=0.002):
+		self.server = server
+		self.max_batch = max_batch
+		self.max_delay = max_delay
+		self.queue = asyncio.Queue()
+		self.batch_sizes = collections.Counter()
+		self.task = None
+
+
+	def start(self):
+		self.task = asyncio.ensure_future(self.run())
+
+
+	async def submit(self, lines, sensor):
+		future = asyncio.get_running_loop().create_future()
+		await self.queue.put((lines, sensor, future))
+		return await future
+
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			batch = [await self.queue.get()]
+			deadline = loop.time() + self.max_delay
+			while len(batch) < self.max_batch:
+				timeout = deadline - loop.time()
+				if timeout <= 0:
+					break
+				try:
+					batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+				except asyncio.TimeoutError:
+					break
+			self.batch_sizes[len(batch)] += 1
+			asyncio.ensure_future(self.dispatch(batch))
+
+
+	async def dispatch(self, batch):
+		lines = [item[0] for item in batch]
+		sensors = [item[1] for item in batch]
+		try:
+			results = await self.server.run_in_pool(_solve_batch, lines, sensors)
+		except Exception as error:
+
+			# Solve a failed batch again one request at a time, so the error only reaches
+			# the request that caused it
+			if len(batch) > 1:
+				await asyncio.gather(*[self.dispatch([item]) for item in batch])
+				return
+			for _, _, future in batch:
+				if not future.done():
+					future.set_exception(error)
+		else:
+			for (_, _, future), coeffs in zip(batch, results):
+				if not future.done():
+					future.set_result(coeffs)
+
+
+
+class CorrectionServer (object):
+
+	'''
+
+	asyncio HTTP server in front of a warm process pool.
+
+	Input:
+
+		workers = int, number of worker processes.
+		max_in_flight = int, requests admitted at once before answering 503.
+		chunk_size = int, size of the chunks used to stream images back.
+		max_body = int, largest request body in bytes, larger ones are answered with 413.
+
+	'''
+
+	def __init__(self, workers=None, max_in_flight=64, chunk_size=1 << 16, max_batch=256, max_delay=0.002, max_body=64 << 20):
+		self.workers = workers or os.cpu_count() or 1
+		self.max_in_flight = max_in_flight
+		self.chunk_size = chunk_size
+		self.max_body = max_body
+		self.in_flight = 0
+		self.rejected = 0
+		self.metrics = LatencyTracker()
+		self.batcher = CoeffBatcher(self, max_batch, max_delay)
+		self.pool = None
+		self.server = None
+
+
+	async def start(self, host="127.0.0.1", port=8642, path=None):
+
+		# Fork and warm every worker before accepting connections
+		self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+		loop = asyncio.get_running_loop()
+		await asyncio.gather(*[loop.run_in_executor(self.pool, _warm_up) for _ in range(2 * self.workers)])
+		self.batcher.start()
+		if path:
+			self.server = await asyncio.start_unix_server(self.handle, path)
+		else:
+			self.server = await asyncio.start_server(self.handle, host, port)
+		return self.server
+
+
+	async def close(self):
+		if self.batcher.task:
+			self.batcher.task.cancel()
+		if self.server:
+			self.server.close()
+			await self.server.wait_closed()
+		if self.pool:
+			self.pool.shutdown()
+
+
+	async def run_in_pool(self, function, *args):
+		return await asyncio.get_running_loop().run_in_executor(self.pool, function, *args)
+
+
+	async def handle(self, reader, writer):
+		try:
+			while True:
+				request = await read_request(reader)
+				if request is None:
+					break
+				method, route, headers = request
+				start = time.perf_counter()
+				length = int(headers.get("content-length", 0))
+				work = method == "POST" and route in ("/coeffs", "/correct")
+
+				# Admission control: oversized and rejected requests are answered before a large
+				# body is read, and the connection is then closed since the body is left unread
+				keep = length <= self.chunk_size
+				if length > self.max_body:
+					status = await send_json(writer, 413, {"error": "body too large"}, close=True)
+					keep = False
+				elif work and self.in_flight >= self.max_in_flight:
+					self.rejected += 1
+					if keep:
+						await reader.readexactly(length)
+					status = await send_json(writer, 503, {"error": "overloaded"}, close=not keep)
+				else:
+					self.in_flight += work
+					try:
+						body = await reader.readexactly(length)
+						status = await self.route(method, route, body, writer)
+					finally:
+						self.in_flight -= work
+				self.metrics.record(route, status, time.perf_counter() - start)
+				if status in (413, 503) and not keep or headers.get("connection", "").lower() == "close":
+					break
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+
+	async def route(self, method, route, body, writer):
+		if method == "GET" and route == "/metrics":
+			return await send_json(writer, 200, self.summary())
+		if method != "POST" or route not in ("/coeffs", "/correct"):
+			return await send_json(writer, 404, {"error": "unknown route"})
+		try:
+			request = json.loads(body)
+			lines, sensor = _parse(request)
+			if route == "/coeffs":
+				if sensor is None:
+					raise KeyError("size")
+				coeffs = await self.batcher.submit(lines, sensor)
+				if not np.all(np.isfinite(coeffs)):
+					return await send_json(writer, 422, {"error": "the lines don't define a real focal distance"})
+				return await send_json(writer, 200, {"coeffs": coeffs})
+			source = request["path"] if "path" in request else base64.b64decode(request["image"])
+			fmt = request.get("format", "PNG")
+			data, coeffs = await self.run_in_pool(_correct, source, lines, sensor, fmt)
+			if data is None:
+				return await send_json(writer, 422, {"error": "the lines don't define a real focal distance"})
+			headers = {"Content-Type": "image/" + fmt.lower(), "X-Coeffs": json.dumps(coeffs)}
+			return await send_stream(writer, 200, headers, data, self.chunk_size)
+		except (KeyError, ValueError, TypeError, OSError) as error:
+			return await send_json(writer, 400, {"error": str(error)})
+		except Exception as error:
+			return await send_json(writer, 500, {"error": repr(error)})
+
+
+	def summary(self):
+		return {
+			"routes": self.metrics.summary(),
+			"in_flight": self.in_flight,
+			"rejected": self.rejected,
+			"workers": self.workers,
+			"coeff_batches": {str(k): n for k, n in sorted(self.batcher.batch_sizes.items())},
+		}
+
+
+
+async def read_request(reader):
+
+	'''
+
+	Reads the request line and headers of one HTTP/1.1 request. Returns (method, route, headers),
+	or None at end of stream. The body is left for the caller to read.
+
+	'''
+
+	line = await reader.readline()
+	if not line:
+		return None
+	method, route, _ = line.decode("latin-1").split(" ", 2)
+	headers = await read_headers(reader)
+	return method, route, headers
+
+
+async def read_headers(reader):
+	headers = {}
+	while True:
+		line = (await reader.readline()).decode("latin-1").strip()
+		if not line:
+			return headers
+		key, value = line.split(":", 1)
+		headers[key.strip().lower()] = value.strip()
+
+
+async def send_json(writer, status, obj, close=False):
+	body = json.dumps(obj).encode()
+	head = "HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n{}\r\n"
+	connection = "Connection: close\r\n" if close else ""
+	writer.write(head.format(status, _reasons.get(status, ""), len(body), connection).encode() + body)
+	await writer.drain()
+	return status
+
+
+async def send_stream(writer, status, headers, data, chunk_size):
+	head = "HTTP/1.1 {} {}\r\nTransfer-Encoding: chunked\r\n".format(status, _reasons.get(status, ""))
+	head += "".join("{}: {}\r\n".format(k, v) for k, v in headers.items())
+	writer.write((head + "\r\n").encode())
+	view = memoryview(data)
+	for i in range(0, len(view), chunk_size):
+		chunk = view[i:i + chunk_size]
+		writer.write(b"%x\r\n" % len(chunk) + chunk + b"\r\n")
+		await writer.drain()
+	writer.write(b"0\r\n\r\n")
+	await writer.drain()
+	return status
+
+
+_reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 413: "Payload Too Large",
+	422: "Unprocessable Entity", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+
+class Client (object):
+
+	'''
+
+	Minimal keep-alive client for CorrectionServer, used for local testing.
+
+	'''
+
+	def __init__(self, host="127.0.0.1", port=8642, path=None):
+		self.host, self.port, self.path = host, port, path
+		self.reader = self.writer = None
+
+
+	async def connect(self):
+		if self.path:
+			self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+		else:
+			self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+		return self
+
+
+	async def close(self):
+		self.writer.close()
+		await self.writer.wait_closed()
+
+
+	async def request(self, method, route, obj=None):
+
+		'''
+
+		Sends a request and returns (status, headers, body), decoding JSON bodies.
+
+		'''
+
+		body = json.dumps(obj).encode() if obj is not None else b""
+		head = "{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {}\r\n\r\n".format(method, route, len(body))
+		self.writer.write(head.encode() + body)
+		await self.writer.drain()
+
+		status = int((await self.reader.readline()).split()[1])
+		headers = await read_headers(self.reader)
+		if headers.get("transfer-encoding") == "chunked":
+			chunks = []
+			while True:
+				size = int(await self.reader.readline(), 16)
+				chunks.append(await self.reader.readexactly(size + 2))
+				if size == 0:
+					break
+			data = b"".join(chunk[:-2] for chunk in chunks)
+		else:
+			data = await self.reader.readexactly(int(headers["content-length"]))
+		if headers.get("content-type") == "application/json":
+			data = json.loads(data)
+		return status, headers, data
+
+
+
+async def selftest(args):
+
+	# Starts a server and drives it with the lines in samples.csv
+	path = "./test_images/"
+	with open(path + "samples.csv") as csvfile:
+		reader = csv.reader(csvfile)
+		header = next(reader)
+		samples = [[row[0], [[row[4*i+1:4*i+3], row[4*i+3:4*i+5]] for i in range(4)]] for row in reader]
+	samples = [[f, [[list(map(int, p)) for p in line] for line in lines]] for f, lines in samples]
+
+	server = CorrectionServer(args.workers, args.max_in_flight)
+	await server.start(args.host, 0 if not args.unix else None, args.unix)
+	port = None if args.unix else server.server.sockets[0].getsockname()[1]
+
+	async def coeff_client(n):
+		client = await Client(args.host, port, args.unix).connect()
+		for i in range(n):
+			filename, lines = samples[i % len(samples)]
+			status, _, body = await client.request("POST", "/coeffs", {"lines": lines, "size": [2048, 2732]})
+			assert status in (200, 422, 503), body
+		await client.close()
+
+	start = time.perf_counter()
+	await asyncio.gather(*[coeff_client(args.requests) for _ in range(args.clients)])
+	elapsed = time.perf_counter() - start
+	print("{} coefficient requests in {:.2f} s".format(args.clients * args.requests, elapsed))
+
+	client = await Client(args.host, port, args.unix).connect()
+	filename, lines = samples[0]
+	status, headers, data = await client.request("POST", "/correct", {"lines": lines, "path": path + filename})
+	print("corrected {}: status {}, {} bytes".format(filename, status, len(data)))
+	status, _, metrics = await client.request("GET", "/metrics")
+	print(json.dumps(metrics, indent=2))
+	await client.close()
+	await server.close()
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Local perspective correction service.")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=8642)
+	parser.add_argument("--unix", help="listen on a Unix socket instead of TCP")
+	parser.add_argument("--workers", type=int, default=None)
+	parser.add_argument("--max-in-flight", type=int, default=64)
+	parser.add_argument("--selftest", action="store_true", help="start a server and drive it with a local client")
+	parser.add_argument("--clients", type=int, default=16)
+	parser.add_argument("--requests", type=int, default=200)
+	args = parser.parse_args()
+
+	if args.selftest:
+		asyncio.run(selftest(args))
+	else:
+		async def main():
+			server = CorrectionServer(args.workers, args.max_in_flight)
+			await server.start(args.host, args.port, args.unix)
+			async with server.server:
+				await server.server.serve_forever()
+		asyncio.run(main())
@@ -0,0 +1,442 @@
+import os
+import csv
+import json
+import time
+import socket
+import argparse
+import threading
+import zlib
+
+
+# Sharded batch correction over a work queue that lives in a directory, e.g. on a filesystem
+# shared by several hosts. The manifest is split into units of work, one JSON file each:
+#
+#   queue/pending/unit-00000.json         waiting to be claimed
+#   queue/leased/unit-00000@node.json     claimed by node, its mtime is the last heartbeat
+#   queue/done/unit-00000.json            finished
+#   queue/results/unit-00000.json         per item coefficients, errors and timings
+#
+# Every state change is a single rename, which is atomic on POSIX filesystems (including
+# NFS), so two nodes can never both claim or both complete the same unit. A node that dies
+# stops renewing its leases, and any node requeues leases that have not been renewed for
+# longer than the lease time.
+
+
+class LeaseLost (Exception):
+	pass
+
+
+
+def _write_json(path, data):
+
+	# Written to a temporary name first so that readers never see a partial file
+	tmp = "{}.{}.{}.tmp".format(path, socket.gethostname(), os.getpid())
+	with open(tmp, "w") as f:
+		json.dump(data, f)
+	os.replace(tmp, path)
+
+
+def read_manifest(path):
+
+	'''
+
+	Reads an annotation manifest in the format of samples.csv and returns a list of
+	(name, source, lines) with source resolved relative to the manifest.
+
+	'''
+
+	directory = os.path.dirname(os.path.abspath(path))
+	items = []
+	with open(path) as csvfile:
+		reader = csv.reader(csvfile)
+		header = next(reader)
+		for row in reader:
+			lines = [[list(map(int, row[4*i+1:4*i+3])), list(map(int, row[4*i+3:4*i+5]))] for i in range(4)]
+			items.append((row[0], os.path.join(directory, row[0]), lines))
+	return items
+
+
+
+class WorkQueue (object):
+
+	'''
+
+	Work queue kept in a directory.
+
+	Input:
+
+		directory = str, root of the queue, created if needed.
+		lease = float, seconds after its last renewal that a claimed unit is given up on.
+
+	'''
+
+	def __init__(self, directory, lease=60.0):
+		self.directory = directory
+		self.lease = lease
+		for state in ("pending", "leased", "done", "results"):
+			os.makedirs(os.path.join(directory, state), exist_ok=True)
+
+
+	def path(self, state, name):
+		return os.path.join(self.directory, state, name)
+
+
+	def split(self, items, unit_size=8):
+
+		'''
+
+		Adds items (name, source, lines) to the queue in units of unit_size items. Returns the
+		number of units created.
+
+		'''
+
+		items = list(items)
+		start = sum(self.counts().values())
+		count = 0
+		for i in range(0, len(items), unit_size):
+			unit = "unit-{:05d}".format(start + count)
+			_write_json(self.path("pending", unit + ".json"), {"unit": unit, "items": items[i:i + unit_size]})
+			count += 1
+		return count
+
+
+	def claim(self, node):
+
+		'''
+
+		Claims a pending unit for node. Returns (unit, data), or None if nothing is pending.
+
+		'''
+
+		names = sorted(n for n in os.listdir(os.path.join(self.directory, "pending")) if n.endswith(".json"))
+
+		# Nodes start looking at different places so they don't all race for the same unit
+		if names:
+			k = zlib.crc32(node.encode()) % len(names)
+			names = names[k:] + names[:k]
+		for name in names:
+			unit = name[:-len(".json")]
+			pending = self.path("pending", name)
+			leased = self.path("leased", "{}@{}.json".format(unit, node))
+
+			# The rename keeps the mtime, so the lease time is set first, otherwise the lease
+			# would look expired to other nodes until it is renewed
+			try:
+				os.utime(pending)
+				os.rename(pending, leased)
+				with open(leased) as f:
+					return unit, json.load(f)
+			except FileNotFoundError:
+				continue
+		return None
+
+
+	def renew(self, unit, node):
+		try:
+			os.utime(self.path("leased", "{}@{}.json".format(unit, node)))
+		except FileNotFoundError:
+			raise LeaseLost(unit)
+
+
+	def complete(self, unit, node, result):
+
+		'''
+
+		Stores the result of a unit and marks it as done. Raises LeaseLost if the unit was
+		requeued in the meantime, in which case the result is discarded.
+
+		'''
+
+		results = self.path("results", "{}@{}.json".format(unit, node))
+		_write_json(results, result)
+		try:
+			os.rename(self.path("leased", "{}@{}.json".format(unit, node)), self.path("done", unit + ".json"))
+		except FileNotFoundError:
+			os.unlink(results)
+			raise LeaseLost(unit)
+		os.replace(results, self.path("results", unit + ".json"))
+
+
+	def requeue_expired(self):
+
+		'''
+
+		Moves units whose lease has not been renewed in time back to pending. Returns the
+		names of the units requeued.
+
+		'''
+
+		now = time.time()
+		requeued = []
+		for entry in os.scandir(os.path.join(self.directory, "leased")):
+			if not entry.name.endswith(".json"):
+				continue
+			try:
+				if now - entry.stat().st_mtime < self.lease:
+					continue
+				unit = entry.name.split("@")[0]
+				os.rename(entry.path, self.path("pending", unit + ".json"))
+			except FileNotFoundError:
+				continue
+			requeued.append(unit)
+		return requeued
+
+
+	def counts(self):
+		return {state: sum(1 for n in os.listdir(os.path.join(self.directory, state)) if n.endswith(".json"))
+			for state in ("pending", "leased", "done")}
+
+
+
+class Heartbeat (object):
+
+	'''
+
+	Renews the lease of a unit from a background thread while it is being processed.
+
+	'''
+
+	def __init__(self, queue, unit, node):
+		self.queue = queue
+		self.unit = unit
+		self.node = node
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+
+	def run(self):
+		while not self.stopped.wait(self.queue.lease / 3):
+			try:
+				self.queue.renew(self.unit, self.node)
+			except LeaseLost:
+				return
+
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+
+
+def process_unit(data, output_dir):
+
+	'''
+
+	Corrects the items of a unit and returns the per item results with timings.
+
+	'''
+
+	from perspectivecache import correct_file
+
+	records = []
+	for name, source, lines in data["items"]:
+		start = time.perf_counter()
+		record = {"name": name}
+		try:
+			format = os.path.splitext(name)[1][1:].upper() or "PNG"
+			encoded, coeffs = correct_file(source, lines[:2], lines[2:], format="JPEG" if format == "JPG" else format)
+			if output_dir:
+				path = os.path.join(output_dir, name)
+				with open(path + ".tmp", "wb") as f:
+					f.write(encoded)
+				os.replace(path + ".tmp", path)
+			record["coeffs"] = list(map(float, coeffs))
+		except Exception as error:
+			record["error"] = repr(error)
+		record["seconds"] = time.perf_counter() - start
+		records.append(record)
+	return records
+
+
+def run_node(queue_dir, output_dir=None, node=None, lease=60.0, idle_exit=True, poll=1.0):
+
+	'''
+
+	Runs one node: claims units until the queue is drained, renewing each lease while the
+	unit is processed and requeueing the expired leases of other nodes along the way.
+
+	Input:
+
+		queue_dir = str, directory of the WorkQueue.
+		output_dir = str, where corrected images are written, or None to only compute them.
+		node = str, name of the node, defaults to host name and process id.
+		lease = float, lease time in seconds.
+		idle_exit = bool, whether to return once nothing is pending or leased.
+		poll = float, seconds to wait when other nodes still hold leases.
+
+	Output:
+
+		Number of units completed by this node.
+
+	'''
+
+	node = node or "{}-{}".format(socket.gethostname(), os.getpid())
+	queue = WorkQueue(queue_dir, lease)
+	if output_dir:
+		os.makedirs(output_dir, exist_ok=True)
+
+	completed = 0
+	while True:
+		queue.requeue_expired()
+		claimed = queue.claim(node)
+		if claimed is None:
+			counts = queue.counts()
+			if idle_exit and counts["pending"] == 0 and counts["leased"] == 0:
+				return completed
+			time.sleep(poll)
+			continue
+
+		unit, data = claimed
+		heartbeat = Heartbeat(queue, unit, node)
+		started = time.time()
+		try:
+			records = process_unit(data, output_dir)
+		finally:
+			heartbeat.stop()
+		finished = time.time()
+
+		result = {"unit": unit, "node": node, "started": started, "finished": finished,
+			"seconds": finished - started, "items": records}
+		try:
+			queue.complete(unit, node, result)
+		except LeaseLost:
+			continue
+		completed += 1
+
+
+def merge_results(queue_dir):
+
+	'''
+
+	Merges the per unit results of a queue into a single summary.
+
+	Output:
+
+		dict with the coefficients or error of every item, and per node and overall timings.
+
+	'''
+
+	results = os.path.join(queue_dir, "results")
+	done = {name[:-len(".json")] for name in os.listdir(os.path.join(queue_dir, "done")) if name.endswith(".json")}
+	final, stranded = {}, {}
+	for name in os.listdir(results):
+		if not name.endswith(".json"):
+			continue
+		with open(os.path.join(results, name)) as f:
+			result = json.load(f)
+		if "@" not in name:
+			final[result["unit"]] = result
+		elif result["unit"] in done and result["finished"] > stranded.get(result["unit"], {"finished": 0})["finished"]:
+			stranded[result["unit"]] = result
+
+	# A node that died between marking a unit done and moving its result into place leaves
+	# the result under its own name
+	for unit, result in stranded.items():
+		final.setdefault(unit, result)
+
+	items, nodes = {}, {}
+	started, finished = [], []
+	for unit, result in sorted(final.items()):
+		node = nodes.setdefault(result["node"], {"units": 0, "items": 0, "errors": 0, "seconds": 0.0})
+		node["units"] += 1
+		node["seconds"] += result["seconds"]
+		for record in result["items"]:
+			items[record["name"]] = record
+			node["items"] += 1
+			node["errors"] += "error" in record
+		started.append(result["started"])
+		finished.append(result["finished"])
+
+	wall = max(finished) - min(started) if started else 0.0
+	return {
+		"items": items,
+		"nodes": nodes,
+		"count": len(items),
+		"errors": sum(node["errors"] for node in nodes.values()),
+		"wall_seconds": wall,
+		"items_per_second": len(items) / wall if wall > 0 else 0.0,
+	}
+
+
+def demo(args):
+
+	'''
+
+	Splits the sample manifest into a fresh queue and drains it with several local processes
+	standing in for nodes, then prints the merged summary.
+
+	'''
+
+	import shutil
+	import tempfile
+	import multiprocessing
+
+	items = read_manifest(args.manifest)
+	items = [item for item in items if os.path.exists(item[1])]
+	items = [("{:04d}_{}".format(i, name), source, lines) for i in range(args.repeat) for name, source, lines in items]
+
+	directory = tempfile.mkdtemp(prefix="perspectiveshard-")
+	try:
+		queue = WorkQueue(os.path.join(directory, "queue"), args.lease)
+		units = queue.split(items, args.unit_size)
+		output_dir = os.path.join(directory, "output")
+
+		nodes = [multiprocessing.Process(target=run_node, args=(queue.directory, output_dir, "node{}".format(i), args.lease))
+			for i in range(args.nodes)]
+		start = time.perf_counter()
+		for process in nodes:
+			process.start()
+		for process in nodes:
+			process.join()
+		elapsed = time.perf_counter() - start
+
+		summary = merge_results(queue.directory)
+		print("{} items in {} units on {} nodes: {:.2f} s, {:.1f} items/s, {} errors".format(
+			summary["count"], units, args.nodes, elapsed, summary["count"] / elapsed, summary["errors"]))
+		for node, stats in sorted(summary["nodes"].items()):
+			print("  {}: {} units, {} items, {:.2f} s busy".format(node, stats["units"], stats["items"], stats["seconds"]))
+	finally:
+		shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Sharded batch correction through a file-based work queue.")
+	commands = parser.add_subparsers(dest="command", required=True)
+
+	split = commands.add_parser("split", help="add the items of a manifest to a queue")
+	split.add_argument("manifest")
+	split.add_argument("queue")
+	split.add_argument("--unit-size", type=int, default=8)
+
+	work = commands.add_parser("work", help="run a node until the queue is drained")
+	work.add_argument("queue")
+	work.add_argument("output", nargs="?")
+	work.add_argument("--node")
+	work.add_argument("--lease", type=float, default=60.0)
+	work.add_argument("--follow", action="store_true", help="keep waiting for new units")
+
+	merge = commands.add_parser("merge", help="merge the results of a queue into a JSON summary")
+	merge.add_argument("queue")
+	merge.add_argument("output", nargs="?")
+
+	local = commands.add_parser("demo", help="drain the sample manifest with local processes as nodes")
+	local.add_argument("--manifest", default="./test_images/samples.csv")
+	local.add_argument("--nodes", type=int, default=4)
+	local.add_argument("--repeat", type=int, default=16)
+	local.add_argument("--unit-size", type=int, default=4)
+	local.add_argument("--lease", type=float, default=30.0)
+
+	args = parser.parse_args()
+	if args.command == "split":
+		print("{} units added".format(WorkQueue(args.queue).split(read_manifest(args.manifest), args.unit_size)))
+	elif args.command == "work":
+		print("{} units completed".format(run_node(args.queue, args.output, args.node, args.lease, not args.follow)))
+	elif args.command == "merge":
+		summary = merge_results(args.queue)
+		if args.output:
+			_write_json(args.output, summary)
+		print("{} items, {} errors, {:.1f} items/s".format(summary["count"], summary["errors"], summary["items_per_second"]))
+	else:
+		demo(args)
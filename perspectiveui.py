@@ -1,9 +1,15 @@
 import ui
 import io
+import os
 import csv
+import queue
+import shutil
+import threading
 import console
 import dialogs
 from perspectivecorrection import *
+from perspectivewarp import TileRenderer
+from perspectiverefine import refine_lines
 from PIL import Image, ImageDraw
 import numpy as np
 from objc_util import ObjCInstance
@@ -14,6 +20,7 @@ class ImageFrame (ui.View):
 	
 	def __init__(self, file, work_area):
 		
+		self.file = file
 		self.image = Image.open(file)
 		self.original = ui.Image.named(file)
 		self.work_area = work_area
@@ -30,17 +37,56 @@ class ImageFrame (ui.View):
 		self.vertical_lines = []
 		self.touchable = True
 		
+		# Snapping the lines to the nearest image edges before correcting is opt-in (Snap button).
+		# The placed and snapped endpoints of each line are kept so that it can be undone
+		self.refine = False
+		self.snapped = None
+		
+		# The corrected image is rendered in tiles for the current viewport only
+		self.renderer = None
+		self.zoom = self.scale
+		self.offset = np.zeros(2)
+		self.fingers = {}
+		
 		
 	def draw(self):
 		
 		if self.buttons[2].active:
-			self.corrected.draw(0, 0, self.width, self.height)
+			# Tiles are rendered at the screen's pixel density and drawn in points
+			k = ui.get_screen_scale()
+			for tile, (x, y, s) in self.renderer.request(k * self.zoom, self.offset, (k * self.width, k * self.height)):
+				tile.draw(x / k, y / k, s / k, s / k)
 		else:
 			self.original.draw(0, 0, self.width, self.height)
+			
+			
+	def viewing(self):
+		return self.renderer is not None and self.buttons[2].active
+		
+		
+	def pan_zoom(self, touch):
+		
+		# One finger pans the corrected image, two fingers pinch to zoom around their midpoint
+		previous = dict(self.fingers)
+		self.fingers[touch.touch_id] = np.array(tuple(touch.location))
+		if len(self.fingers) == 1:
+			self.offset -= (self.fingers[touch.touch_id] - previous[touch.touch_id]) / self.zoom
+		elif len(self.fingers) == 2:
+			a0, b0 = previous.values()
+			a1, b1 = self.fingers.values()
+			ratio = np.linalg.norm(b1 - a1) / max(np.linalg.norm(b0 - a0), 1)
+			anchor = self.offset + 0.5 * (a0 + b0) / self.zoom
+			self.zoom = min(max(self.zoom * ratio, 0.5 * self.scale), 4)
+			self.offset = anchor - 0.5 * (a1 + b1) / self.zoom
+		self.set_needs_display()
 		
 		
 	def touch_began(self, touch):
 		
+		if self.viewing():
+			self.fingers[touch.touch_id] = np.array(tuple(touch.location))
+			return
+			
 		ui_touch = ObjCInstance(touch)
 		if self.touchable and ui_touch.type() == 2:
 			
@@ -64,6 +110,10 @@ class ImageFrame (ui.View):
 		
 	def touch_moved(self, touch):
 		
+		if self.viewing():
+			self.pan_zoom(touch)
+			return
+			
 		ui_touch = ObjCInstance(touch)
 		if self.touchable and ui_touch.type() == 2:
 			self.points[-1].center = touch.location
@@ -73,6 +123,10 @@ class ImageFrame (ui.View):
 	
 	def touch_ended(self, touch):
 		
+		if self.viewing():
+			self.fingers.pop(touch.touch_id, None)
+			return
+			
 		if len(self.points) == 4:
 			self.buttons[1].border_color = "white"
 			self.buttons[1].tint_color = "white"
@@ -147,8 +201,87 @@ class Line (ui.View):
 		
 		
 
+class ExportQueue (object):
+	
+	'''
+	
+	Adds annotated examples to samples.csv from a background thread, so that the next image
+	can be annotated while earlier ones are still being written. The number of rows is only
+	counted once, and sources in a format PIL reads are hard-linked (or copied) into the test
+	images instead of being decoded and encoded again.
+	
+	'''
+	
+	LINKABLE = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+	
+	def __init__(self, path, on_progress=None):
+		self.path = path
+		self.on_progress = on_progress
+		with open(os.path.join(path, "samples.csv"), newline = "") as samples:
+			self.count = sum(1 for _ in csv.reader(samples))
+		self.pending = 0
+		self.lock = threading.Lock()
+		self.jobs = queue.Queue()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+		
+		
+	def submit(self, file, image, lines):
+		
+		# The name is reserved right away so that queued exports never collide
+		ext = os.path.splitext(file)[1].lower()
+		with self.lock:
+			filename = "test_{}{}".format(self.count, ext if ext in self.LINKABLE else ".png")
+			self.count += 1
+			self.pending += 1
+		self.jobs.put((file, image, filename, lines))
+		return filename
+		
+		
+	def run(self):
+		while True:
+			file, image, filename, lines = self.jobs.get()
+			error = None
+			try:
+				self.write(file, image, filename, lines)
+			except Exception as e:
+				error = e
+			with self.lock:
+				self.pending -= 1
+				pending = self.pending
+			if self.on_progress:
+				self.on_progress(filename, pending, error)
+				
+				
+	def write(self, file, image, filename, lines):
+		destination = os.path.join(self.path, filename)
+		if filename.endswith(".png") and not file.lower().endswith(".png"):
+			image.save(destination)
+		else:
+			try:
+				os.link(file, destination)
+			except OSError:
+				shutil.copyfile(file, destination)
+		with open(os.path.join(self.path, "samples.csv"), "a", newline = "") as samples:
+			csv.writer(samples).writerow([filename, *lines])
+			
+			
+			
 class ButtonHandler (object):
 	
+	def __init__(self):
+		self.file_button = None
+		self.exports = ExportQueue("./test_images/", on_progress = self.exported)
+		
+		
+	def exported(self, filename, pending, error):
+		if error:
+			message = "Export of {} failed".format(filename)
+		else:
+			message = "Exported {}".format(filename) + (", {} left".format(pending) if pending else "")
+		ui.delay(lambda: console.hud_alert(message, "error" if error else "success", 1), 0)
+		
+		
 	def switcher(self, sender):
 		control = sender.control
 		buttons = control.buttons
@@ -191,40 +324,83 @@ class ButtonHandler (object):
 			horizontal_lines = [[tuple(1/scale*l.p1), tuple(1/scale*l.p2)] for l in control.horizontal_lines]
 			vertical_lines = [[tuple(1/scale*l.p1), tuple(1/scale*l.p2)] for l in control.vertical_lines]
 			image = control.image
+			source = np.asarray(image.convert("RGB"))
 			width, height = image.size
 			sensor = np.array([[width/2, height/2, 0]])
+			
+			# A point placed on screen is off by a few source pixels per screen point, but a wider
+			# search can jump to a neighbouring edge, so it is capped in source pixels
+			if control.refine:
+				horizontal_lines, vertical_lines = refine_lines(source, horizontal_lines, vertical_lines, search = min(24, max(8, 2/scale)))
+				snapped = []
+				for i, refined in enumerate(horizontal_lines + vertical_lines):
+					line = control.lines[i]
+					placed = (tuple(line.p1), tuple(line.p2))
+					
+					# Lines that were snapped before and not moved since keep their placed endpoints
+					if control.snapped and control.snapped[i][1] == placed:
+						placed = control.snapped[i][0]
+					self.move_line(control, i, *[(scale * x, scale * y) for x, y in refined])
+					snapped.append((placed, (tuple(line.p1), tuple(line.p2))))
+				control.snapped = snapped
 			coeffs = find_persp_coeffs_from_lines(horizontal_lines, vertical_lines, sensor)
-			corrected_image = image.transform((width, height), Image.PERSPECTIVE, coeffs, Image.BICUBIC)
-			control.corrected = pil2ui(corrected_image)
-			corrected_image.show()
+			
+			# Render only what is on screen, on demand, instead of warping the full image
+			if control.renderer:
+				control.renderer.close()
+			control.renderer = TileRenderer(source, coeffs,
+				on_ready = lambda: ui.delay(control.set_needs_display, 0), convert = array2ui)
+			control.zoom, control.offset = scale, np.zeros(2)
+			control.touch_enabled = True
 		sender.control.set_needs_display()
 		
 		
+	def move_line(self, control, i, p1, p2):
+		line = control.lines[i]
+		line.p1, line.p2 = ui.Point(*p1), ui.Point(*p2)
+		control.points[2*i].center, control.points[2*i + 1].center = line.p1, line.p2
+		line.set_needs_display()
+		
+		
+	def snap(self, sender):
+		control = sender.control
+		control.refine = not control.refine
+		sender.border_color = "#007fff" if control.refine else "white"
+		sender.tint_color = "#007fff" if control.refine else "white"
+		
+		# Turning snapping off puts back the placed endpoints of the lines that were not moved
+		if not control.refine and control.snapped:
+			for i, (placed, snapped) in enumerate(control.snapped):
+				line = control.lines[i]
+				if (tuple(line.p1), tuple(line.p2)) == snapped:
+					self.move_line(control, i, *placed)
+			control.snapped = None
+		if control.buttons[2].active:
+			self.switcher(control.buttons[2])
+		
+		
 	def cancel(self, sender):
 		sender.superview.superview.close()
 		
 	
 	def export(self, sender):
 		control = sender.control
+		canvas = sender.superview.superview
 		if console.alert("Export", "Would you like to add this example to demo.py?", "Yes", "No") == 1:
-			path = "./test_images/"
-			with open(path + "samples.csv", "r+", newline = "") as samples:
-				#writer = csv.writer(samples)
-				#writer.writerow(['Name', 'h11x', 'h11y', 'h12x', 'h12y', 'h21x', 'h21y', 'h22x', 'h22y', 
-				#						'v11x', 'v11y', 'v12x', 'v12y', 'v21x', 'v21y', 'v22x', 'v22y'])
-				reader = csv.reader(samples)
-				n = 0
-				for _ in reader:
-					n += 1
-				filename = "test_{}.png".format(n)
-				writer = csv.writer(samples)
-				control.image.save(path + filename)
-				scale = control.scale
-				lines = control.lines
-				row = [filename]
-				row.extend([str(round(k/scale)) for l in lines for p in [l.p1, l.p2] for k in p])
-				writer.writerow(row)
-		sender.superview.superview.close()
+			scale = control.scale
+			lines = [str(round(k/scale)) for l in control.lines for p in [l.p1, l.p2] for k in p]
+			self.exports.submit(control.file, control.image, lines)
+		self.reset(canvas, control)
+		
+		
+	def reset(self, canvas, control):
+		
+		# Clear the canvas for the next image while the export finishes in the background
+		if control.renderer:
+			control.renderer.close()
+		for view in list(canvas.subviews):
+			canvas.remove_subview(view)
+		canvas.add_subview(self.file_button)
 		
 
 	def pick_pic(self, sender):
@@ -306,6 +482,19 @@ class ButtonHandler (object):
 			done.control = image
 			top_bar.add_subview(done)
 			
+			snap = ui.Button(title = "Snap")
+			snap.width = 70
+			snap.height = 30
+			snap.corner_radius = 10
+			snap.border_width = 2
+			snap.border_color = "white"
+			snap.tint_color = "white"
+			snap.center = (bottom_bar.width/2, 25)
+			snap.action = self.snap
+			snap.control = image
+			bottom_bar.add_subview(snap)
+			
+			self.file_button = sender
 			canvas.remove_subview(sender)
 			
 			
@@ -318,6 +507,10 @@ def pil2ui(imgIn):
 		imgOut = ui.Image.from_data(bIO.getvalue())
 	del bIO
 	return imgOut
+	
+	
+def array2ui(array):
+	return pil2ui(Image.fromarray(array))
 
 	
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from perspectivecorrection import find_persp_coeffs_from_lines, _to_matrix, _to_coeffs
+
+
+def _to_array(frame):
+	return np.asarray(frame)
+
+
+def _gray(window):
+
+	# Luma of an (h, w) or (h, w, 3) window, as float32
+	window = window.astype(np.float32)
+	if window.ndim == 3:
+		window = window[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+	return window
+
+
+def track_point(previous, current, point, patch=7, search=12):
+
+	'''
+
+	Finds where point has moved between two frames by matching the patch around it in the
+	previous frame against every position within search pixels in the current frame.
+
+	Input:
+
+		previous, current = np.array frames of shape (height, width) or (height, width, channels).
+		point = (x, y), location of the point in the previous frame.
+		patch = int, half size of the template.
+		search = int, largest displacement considered, in pixels.
+
+	Output:
+
+		(x, y), location of the point in the current frame, with sub-pixel precision.
+
+	'''
+
+	height, width = previous.shape[:2]
+	r = patch + search
+	x, y = int(round(point[0])), int(round(point[1]))
+	if x < r or y < r or x >= width - r or y >= height - r:
+		return point
+
+	# Only the windows around the point are converted to grayscale
+	template = _gray(previous[y - patch:y + patch + 1, x - patch:x + patch + 1])
+	region = _gray(current[y - r:y + r + 1, x - r:x + r + 1])
+	windows = sliding_window_view(region, template.shape)
+	ssd = np.sum((windows - template) ** 2, axis=(-2, -1))
+
+	dy, dx = np.unravel_index(np.argmin(ssd), ssd.shape)
+
+	# Refine with a parabola through the neighbouring scores
+	def vertex(a, b, c):
+		d = a - 2 * b + c
+		return 0.5 * (a - c) / d if d > 0 else 0
+
+	sx = vertex(ssd[dy, dx - 1], ssd[dy, dx], ssd[dy, dx + 1]) if 0 < dx < 2 * search else 0
+	sy = vertex(ssd[dy - 1, dx], ssd[dy, dx], ssd[dy + 1, dx]) if 0 < dy < 2 * search else 0
+
+	return (point[0] + dx - search + sx, point[1] + dy - search + sy)
+
+
+
+class SequenceCorrector (object):
+
+	'''
+
+	Corrects a sequence of frames from lines annotated on a keyframe.
+
+	The line endpoints are tracked from frame to frame, the resulting coefficients are
+	smoothed over time, and each frame is warped with Image.transform. The coefficients of the
+	previous frame are reused as long as the smoothed homography moves no output pixel by more
+	than tolerance source pixels, which also keeps the output still against tracking jitter.
+
+	Input:
+
+		keyframe = PIL.Image or np.array, the frame the lines were drawn on.
+		horizontal_lines, vertical_lines = as in find_persp_coeffs_from_lines.
+		sensor = np.array([[x, y, z]]), defaults to the center of the frame.
+		size = (width, height) of the output, defaults to the size of the frame.
+		smoothing = float in (0, 1], weight of the newest coefficients in the running average.
+		tolerance = float, largest source displacement (in pixels) allowed before the coefficients
+			used for the warp are updated.
+		patch, search = passed to track_point.
+		resample = PIL resampling filter, defaults to Image.BILINEAR.
+
+	'''
+
+	def __init__(self, keyframe, horizontal_lines, vertical_lines, sensor=None, size=None,
+			smoothing=0.3, tolerance=0.5, patch=7, search=12, resample=None):
+
+		from PIL import Image
+
+		self.previous = _to_array(keyframe)
+		height, width = self.previous.shape[:2]
+		self.size = size or (width, height)
+		self.sensor = sensor if sensor is not None else np.array([[width/2, height/2, 0]])
+		self.points = [p for line in [*horizontal_lines, *vertical_lines] for p in line]
+		self.smoothing = smoothing
+		self.tolerance = tolerance
+		self.patch = patch
+		self.search = search
+		self.resample = resample if resample is not None else Image.BILINEAR
+		self.H = self.solve()
+
+		# Homography the frames are warped with, and how often it was reused or updated
+		self.applied = self.H
+		self.reused = 0
+		self.updated = 0
+
+		# Output corners and center, used to measure how far the homography has moved
+		w, h = self.size
+		self.probes = np.array([[0, 0, 1], [w, 0, 1], [0, h, 1], [w, h, 1], [w/2, h/2, 1]], dtype=np.float64)
+
+
+	def solve(self):
+		lines = [[self.points[2*i], self.points[2*i + 1]] for i in range(4)]
+		return _to_matrix(find_persp_coeffs_from_lines(lines[:2], lines[2:], self.sensor))
+
+
+	@property
+	def coeffs(self):
+		return _to_coeffs(self.applied)
+
+
+	def displacement(self, H1, H2):
+
+		# Largest distance between where H1 and H2 send the probe points
+		p1, p2 = self.probes @ H1.T, self.probes @ H2.T
+		return np.max(np.linalg.norm(p1[:, :2] / p1[:, 2:] - p2[:, :2] / p2[:, 2:], axis=1))
+
+
+	def update(self, frame):
+
+		'''
+
+		Tracks the line endpoints into frame and updates the smoothed homography.
+
+		'''
+
+		frame = _to_array(frame)
+		self.points = [track_point(self.previous, frame, p, self.patch, self.search) for p in self.points]
+		self.previous = frame
+
+		H = self.solve()
+		if np.all(np.isfinite(H)):
+			H = H / H[2, 2]
+			self.H = self.smoothing * H + (1 - self.smoothing) * self.H / self.H[2, 2]
+		if self.displacement(self.H, self.applied) > self.tolerance:
+			self.applied = self.H
+			self.updated += 1
+		else:
+			self.reused += 1
+		return frame
+
+
+	def correct(self, frame, out=None):
+
+		'''
+
+		Corrects a single frame of the sequence and returns it as an array, written into out
+		if given.
+
+		'''
+
+		from PIL import Image
+
+		image = frame if hasattr(frame, "transform") else None
+		frame = self.update(frame)
+		if image is None:
+			image = Image.fromarray(frame)
+		corrected = np.asarray(image.transform(self.size, Image.PERSPECTIVE, self.coeffs, self.resample))
+		if out is None:
+			return corrected
+		out[...] = corrected
+		return out
+
+
+
+def correct_sequence(frames, horizontal_lines, vertical_lines, sensor=None, **options):
+
+	'''
+
+	Corrects an iterable of frames, the first being the keyframe the lines were drawn on.
+	Yields each corrected frame as an np.array.
+
+	'''
+
+	frames = iter(frames)
+	keyframe = next(frames)
+	corrector = SequenceCorrector(keyframe, horizontal_lines, vertical_lines, sensor, **options)
+	yield corrector.correct(keyframe)
+	for frame in frames:
+		yield corrector.correct(frame)
+
+
+if __name__ == "__main__":
+
+	import time
+	from PIL import Image
+
+	# Simulate a slowly drifting camera over a test image and report throughput
+	file = "./test_images/test_1.png"
+	image = Image.open(file).convert("RGB")
+	horizontal_lines = [[(356, 318), (1120, 106)], [(391, 1321), (838, 1399)]]
+	vertical_lines = [[(868, 437), (880, 1326)], [(393, 544), (382, 1231)]]
+
+	source = np.asarray(image)
+	frames = [np.roll(source, (i // 10, i // 15), axis=(0, 1)) for i in range(60)]
+
+	corrector = SequenceCorrector(frames[0], horizontal_lines, vertical_lines)
+	start = time.perf_counter()
+	for frame in frames:
+		corrector.correct(frame)
+	elapsed = time.perf_counter() - start
+	print("{} frames of {}x{} in {:.2f} s ({:.1f} fps), coefficients updated {} times, reused {} times".format(
+		len(frames), *image.size, elapsed, len(frames) / elapsed, corrector.updated, corrector.reused))
+	print("tracked endpoints:", [tuple(round(k, 1) for k in p) for p in corrector.points[:2]])
@@ -0,0 +1,361 @@
+import threading
+import collections
+import numpy as np
+from perspectivecorrection import _to_matrix
+
+
+# NumPy warp engine. Unlike Image.transform it works on arrays (including shared memory and
+# memory-mapped files), can write into a pre-allocated output, can render any box of the
+# output on its own, and can keep the per-pixel coordinate map around to be reused.
+#
+# Coordinates follow Image.transform: output pixel (x, y) is sampled at the source location
+# given by applying the coefficients to its center (x + 0.5, y + 0.5).
+
+
+def coordinate_map(coeffs, box, dtype=np.float32, camera=None):
+
+	'''
+
+	Finds the source coordinates sampled by each output pixel in box.
+
+	Input:
+
+		coeffs = np.array([c0, ..., c7]), perspective coefficients mapping output to source.
+		box = (left, top, right, bottom), region of the output image.
+		dtype = precision of the map.
+		camera = perspectivelens.Camera, lens distortion of the source, applied after the
+			homography so that undistortion and correction share one resampling pass.
+
+	Output:
+
+		(map_x, map_y), arrays of shape (bottom - top, right - left) holding source pixel
+		coordinates, where integer values fall on source pixel centers.
+
+	'''
+
+	H = _to_matrix(coeffs)
+	left, top, right, bottom = box
+	x = np.arange(left, right, dtype=np.float64) + 0.5
+	y = np.arange(top, bottom, dtype=np.float64)[:, None] + 0.5
+
+	# Each row of the map is affine in x, so build it from outer sums
+	w = H[2, 0] * x + (H[2, 1] * y + H[2, 2])
+	map_x = (H[0, 0] * x + (H[0, 1] * y + H[0, 2])) / w
+	map_y = (H[1, 0] * x + (H[1, 1] * y + H[1, 2])) / w
+	if camera is not None:
+		map_x, map_y = camera.distort(map_x, map_y)
+
+	return (map_x - 0.5).astype(dtype, copy=False), (map_y - 0.5).astype(dtype, copy=False)
+
+
+class WarpMap (object):
+
+	'''
+
+	Bilinear sampling pattern for a coordinate map, precomputed once so that it can be applied
+	to any number of source images of the same shape.
+
+	Input:
+
+		map_x, map_y = arrays from coordinate_map.
+		source_shape = (height, width) of the source images.
+
+	'''
+
+	def __init__(self, map_x, map_y, source_shape):
+
+		height, width = source_shape[:2]
+		self.shape = map_x.shape
+		self.source_shape = (height, width)
+		map_x, map_y = map_x.ravel(), map_y.ravel()
+
+		# Pixels sampling outside the source are filled instead
+		self.valid = (map_x > -1) & (map_x < width) & (map_y > -1) & (map_y < height)
+
+		x0, y0 = np.floor(map_x), np.floor(map_y)
+		fx, fy = (map_x - x0).astype(np.float32), (map_y - y0).astype(np.float32)
+		x0 = x0.astype(np.intp)
+		y0 = y0.astype(np.intp)
+		x1 = np.clip(x0 + 1, 0, width - 1)
+		y1 = np.clip(y0 + 1, 0, height - 1)
+		np.clip(x0, 0, width - 1, out=x0)
+		np.clip(y0, 0, height - 1, out=y0)
+
+		self.index = [y0 * width + x0, y0 * width + x1, y1 * width + x0, y1 * width + x1]
+		self.weight = [(1 - fx) * (1 - fy), fx * (1 - fy), (1 - fx) * fy, fx * fy]
+
+
+	def apply(self, source, out=None, fill=0):
+
+		'''
+
+		Samples source (an array of shape (height, width) or (height, width, channels), or any
+		object supporting take_flat(index)) into out, which is allocated if not given.
+
+		'''
+
+		channels = source.shape[2:]
+		if out is None:
+			out = np.empty(self.shape + channels, dtype=source.dtype)
+		if hasattr(source, "take_flat"):
+			take = source.take_flat
+		else:
+			flat = np.asarray(source).reshape((-1,) + channels)
+			take = lambda index: flat.take(index, axis=0)
+
+		weight = [w.reshape((-1,) + (1,) * len(channels)) for w in self.weight]
+		acc = np.multiply(take(self.index[0]), weight[0], dtype=np.float32)
+		tmp = np.empty_like(acc)
+		for i in range(1, 4):
+			acc += np.multiply(take(self.index[i]), weight[i], out=tmp)
+		acc[~self.valid] = fill
+
+		# Bilinear weights sum to one, so rounding is all integer outputs need
+		if np.issubdtype(out.dtype, np.integer):
+			acc += 0.5
+		out.reshape((-1,) + channels)[...] = acc
+		return out
+
+
+def halve(array, rows=256):
+
+	'''
+
+	Downscales array by two with 2x2 averaging. The work is done rows output rows at a time,
+	so only a small float copy of the source exists at once.
+
+	'''
+
+	height, width = array.shape[0] // 2 * 2, array.shape[1] // 2 * 2
+	out = np.empty((height // 2, width // 2) + array.shape[2:], dtype=array.dtype)
+	rounding = 0.5 if np.issubdtype(array.dtype, np.integer) else 0
+	for top in range(0, height, 2 * rows):
+		a = array[top:min(top + 2 * rows, height), :width].astype(np.float32)
+		a = 0.25 * (a[0::2, 0::2] + a[1::2, 0::2] + a[0::2, 1::2] + a[1::2, 1::2]) + rounding
+		out[top // 2:top // 2 + len(a)] = a
+	return out
+
+
+def remap(source, map_x, map_y, out=None, fill=0):
+
+	'''
+
+	Bilinearly samples source at the coordinates in (map_x, map_y).
+
+	'''
+
+	return WarpMap(map_x, map_y, source.shape).apply(source, out, fill)
+
+
+def warp(source, coeffs, size, out=None, band_height=256, fill=0, camera=None):
+
+	'''
+
+	Array counterpart of Image.transform with Image.PERSPECTIVE and bilinear filtering. The
+	output is rendered in bands of rows so that temporary memory stays proportional to
+	band_height rather than to the whole output.
+
+	Input:
+
+		source = np.array of shape (height, width) or (height, width, channels).
+		coeffs = np.array([c0, ..., c7]), perspective coefficients.
+		size = (width, height) of the output.
+		out = pre-allocated output array, e.g. shared memory or a memory-mapped file.
+		band_height = number of output rows rendered at a time.
+		camera = perspectivelens.Camera, lens distortion of the source, see coordinate_map.
+
+	Output:
+
+		out, the corrected image.
+
+	'''
+
+	width, height = size
+	if out is None:
+		out = np.empty((height, width) + source.shape[2:], dtype=source.dtype)
+	for top, band in iter_bands(source, coeffs, size, band_height, fill, camera):
+		out[top:top + len(band)] = band
+	return out
+
+
+def iter_bands(source, coeffs, size, band_height=256, fill=0, camera=None):
+
+	'''
+
+	Renders the corrected image one band of rows at a time, yielding (top, band).
+
+	'''
+
+	width, height = size
+	for top in range(0, height, band_height):
+		bottom = min(top + band_height, height)
+		map_x, map_y = coordinate_map(coeffs, (0, top, width, bottom), camera=camera)
+		yield top, remap(source, map_x, map_y, fill=fill)
+
+
+class TileRenderer (object):
+
+	'''
+
+	Renders the corrected image on demand for a pan and zoom viewer, one screen-resolution
+	tile at a time, instead of warping the whole image at full resolution.
+
+	The viewport is given by zoom (screen pixels per corrected pixel) and the corrected
+	coordinates of its top left corner. Tiles are rendered at power of two zoom levels, the
+	smallest one at least as sharp as the screen, on a fixed grid at each level, and drawn
+	scaled to the actual zoom, so panning and pinching reuse the tiles already rendered. Missing
+	tiles are rendered by a background thread, most recently requested first, and the most
+	recent ones are kept in an LRU cache. While they render, tiles of other levels already in
+	the cache stand in for them. Zoomed out views sample a downscaled copy of the source so
+	they don't alias.
+
+	Input:
+
+		source = np.array of shape (height, width) or (height, width, channels).
+		coeffs = np.array([c0, ..., c7]), perspective coefficients of the full resolution output.
+		tile_size = int, width and height of a tile in screen pixels.
+		cache_tiles = int, number of rendered tiles kept.
+		on_ready = function called from the background thread whenever a tile is done.
+		convert = function applied to each rendered tile (e.g. to make a ui.Image) before caching.
+
+	'''
+
+	def __init__(self, source, coeffs, tile_size=256, cache_tiles=96, on_ready=None, convert=None):
+		self.levels = [np.asarray(source)]
+		self.H = _to_matrix(coeffs)
+		self.tile_size = tile_size
+		self.cache_tiles = cache_tiles
+		self.on_ready = on_ready
+		self.convert = convert
+
+		self.tiles = collections.OrderedDict()
+		self.wanted = []
+		self.lock = threading.Condition()
+		self.closed = False
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+
+	def level(self, k):
+
+		# Source downscaled by 2 ** k, built by 2x2 averaging a band of rows at a time the first
+		# time it is needed
+		while len(self.levels) <= k:
+			a = self.levels[-1]
+			if a.shape[0] < 2 or a.shape[1] < 2:
+				break
+			self.levels.append(halve(a))
+		return self.levels[min(k, len(self.levels) - 1)]
+
+
+	@staticmethod
+	def zoom_level(zoom):
+
+		# Smallest power of two at least as large as zoom
+		return int(np.ceil(np.log2(zoom) - 1e-9))
+
+
+	def render(self, key):
+
+		'''
+
+		Renders the tile key = (level, i, j) at zoom 2 ** level and returns it as an array.
+
+		'''
+
+		level, i, j = key
+		zoom = 2.0 ** level
+		T = self.tile_size
+
+		# Screen pixel (u, v) of tile (i, j) is at corrected ((i*T + u) / zoom, (j*T + v) / zoom)
+		S = np.array([[1/zoom, 0, i*T/zoom], [0, 1/zoom, j*T/zoom], [0, 0, 1]])
+
+		# Sample a source level whose density roughly matches the screen
+		k = max(int(np.floor(np.log2(1 / zoom))), 0) if zoom < 1 else 0
+		source = self.level(k)
+		scale = self.levels[0].shape[0] / source.shape[0]
+		D = np.diag([1/scale, 1/scale, 1])
+
+		H = D @ self.H @ S
+		map_x, map_y = coordinate_map((H / H[2, 2]).ravel()[:8], (0, 0, T, T))
+		return remap(source, map_x, map_y)
+
+
+	def visible(self, level, zoom, offset, size):
+
+		'''
+
+		Lists the tiles of a zoom level covering a viewport as ((level, i, j), (x, y, s)), where
+		(x, y) is the position of the tile on screen and s the size it is drawn at.
+
+		'''
+
+		T = self.tile_size
+		s = T * zoom / 2.0 ** level
+		left, top = offset[0] * zoom / s, offset[1] * zoom / s
+		keys = []
+		for j in range(int(np.floor(top)), int(np.ceil(top + size[1] / s))):
+			for i in range(int(np.floor(left)), int(np.ceil(left + size[0] / s))):
+				keys.append(((level, i, j), ((i - left) * s, (j - top) * s, s)))
+		return keys
+
+
+	def request(self, zoom, offset, size):
+
+		'''
+
+		Returns [(tile, (x, y, s)), ...] for the tiles of the viewport that are ready, in the
+		order they should be drawn, and queues the missing ones for the background thread.
+
+		'''
+
+		level = self.zoom_level(zoom)
+		ready, missing = [], []
+		with self.lock:
+			for key, position in self.visible(level, zoom, offset, size):
+				if key in self.tiles:
+					self.tiles.move_to_end(key)
+					ready.append((self.tiles[key], position))
+				else:
+					missing.append((key, position))
+
+			# Cover the missing tiles with cached tiles of other levels, the nearest level drawn last
+			overlaps = lambda a, b: a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[2] and b[1] < a[1] + a[2]
+			others = sorted({key[0] for key in self.tiles} - {level}, key=lambda other: -abs(other - level))
+			stand_ins = []
+			for other in others if missing else []:
+				for key, position in self.visible(other, zoom, offset, size):
+					if key in self.tiles and any(overlaps(position, p) for _, p in missing):
+						stand_ins.append((self.tiles[key], position))
+
+			# Only the current viewport is worth rendering
+			self.wanted = [key for key, _ in missing[::-1]]
+			self.lock.notify()
+		return stand_ins + ready
+
+
+	def run(self):
+		while True:
+			with self.lock:
+				while not self.wanted and not self.closed:
+					self.lock.wait()
+				if self.closed:
+					return
+				key = self.wanted.pop()
+
+			tile = self.render(key)
+			if self.convert:
+				tile = self.convert(tile)
+
+			with self.lock:
+				self.tiles[key] = tile
+				while len(self.tiles) > self.cache_tiles:
+					self.tiles.popitem(last=False)
+			if self.on_ready:
+				self.on_ready()
+
+
+	def close(self):
+		with self.lock:
+			self.closed = True
+			self.lock.notify()